@@ -0,0 +1,111 @@
+#!/bin/python3
+
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Benchmarks of the migration script, they don't need a homeserver.
+ *
+ * Run all of them with `python3 benchmark.py` or a single one with
+ * `python3 benchmark.py startup`.
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import utils
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def timed_runs(func, runs):
+    durations = []
+    for i in range(runs):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def report(name, durations):
+    print("%-30s min %8.2fms  median %8.2fms  (%d runs)" % (name, min(durations) * 1000, statistics.median(durations) * 1000, len(durations)))
+
+def run_python(*args):
+    subprocess.run([sys.executable] + list(args), cwd=here, check=True, stdout=subprocess.DEVNULL)
+
+def bench_startup(runs):
+    report("interpreter", timed_runs(lambda: run_python("-c", "pass"), runs))
+    report("import migrate", timed_runs(lambda: run_python("-c", "import migrate"), runs))
+    report("migrate.py --help", timed_runs(lambda: run_python("migrate.py", "--help"), runs))
+
+def day_file(messages):
+    # a day file of a busy channel, with threads and reactions
+    day = []
+    for i in range(messages):
+        message = {
+            "type": "message",
+            "user": "U%05d" % (i % 50),
+            "text": "Message number %d with some <@U%05d> mention and :smile: emoji äöü" % (i, (i + 1) % 50),
+            "ts": "1577923200.%06d" % i,
+            "reactions": [{"name": "thumbsup", "users": ["U00001", "U00002"], "count": 2}],
+        }
+        if i % 10 == 0:
+            message["replies"] = [{"user": "U00003", "ts": "1577923300.%06d" % i}]
+        day.append(message)
+    return json.dumps(day).encode("utf-8")
+
+def bench_codec(runs):
+    data = day_file(2000)
+    messages = json.loads(data)
+    body = {"msgtype": "m.text", "body": messages[0]["text"], "format": "org.matrix.custom.html", "formatted_body": "<p>" + messages[0]["text"] + "</p>"}
+
+    # what requests' json= does
+    stdlibLoad = timed_runs(lambda: json.loads(data), runs)
+    stdlibDump = timed_runs(lambda: [json.dumps(body, allow_nan=False).encode("utf-8") for i in range(1000)], runs)
+    report("day file json", stdlibLoad)
+    report("1000 bodies json", stdlibDump)
+    if utils.orjson is None:
+        print("orjson is not installed, the migration uses json")
+        return
+
+    fastLoad = timed_runs(lambda: utils.json_loads(data), runs)
+    fastDump = timed_runs(lambda: [utils.json_dumps(body) for i in range(1000)], runs)
+    report("day file orjson", fastLoad)
+    report("1000 bodies orjson", fastDump)
+    print("speedup: parsing %.1fx, serializing %.1fx" % (statistics.median(stdlibLoad) / statistics.median(fastLoad), statistics.median(stdlibDump) / statistics.median(fastDump)))
+
+benchmarks = {
+    "codec": bench_codec,
+    "startup": bench_startup,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the Slack migration")
+    parser.add_argument("benchmark", nargs="*", help="benchmarks to run: %s (default: all)" % ", ".join(sorted(benchmarks)))
+    parser.add_argument("-n", "--runs", type=int, default=10, help="runs per measurement")
+    args = parser.parse_args()
+
+    for name in args.benchmark:
+        if not name in benchmarks:
+            parser.error("unknown benchmark " + name)
+
+    for name in args.benchmark or sorted(benchmarks):
+        print("## " + name)
+        benchmarks[name](args.runs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import tempfile
+import threading
+
+class ContentCache(object):
+    '''Slack downloads on disk, keyed by Slack file id and URL variant
+    ("original", "thumb_360", "thumb_video").
+
+    Files are written atomically and the least recently used ones are
+    removed once the cache grows over maxBytes.
+    '''
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # path -> size of every cached file, oldest first
+        self.entries = {}
+        self.size = 0
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith(".") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(files):
+            self.entries[path] = size
+            self.size += size
+
+    def path(self, fileId, variant):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_-]', '_', fileId) + "." + variant)
+
+    def get(self, fileId, variant):
+        path = self.path(fileId, variant)
+        with self.lock:
+            if not path in self.entries:
+                return None
+            # mark as recently used, for the eviction and the next run
+            self.entries[path] = self.entries.pop(path)
+        try:
+            os.utime(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            with self.lock:
+                self.size -= self.entries.pop(path, 0)
+            return None
+
+    def put(self, fileId, variant, data):
+        if len(data) > self.maxBytes:
+            return
+
+        path = self.path(fileId, variant)
+        # write to a temporary file first, a crash must not leave half a file behind
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self.lock:
+            self.size -= self.entries.pop(path, 0)
+            self.entries[path] = len(data)
+            self.size += len(data)
+
+            while self.size > self.maxBytes:
+                oldest = next(iter(self.entries))
+                self.size -= self.entries.pop(oldest)
+                try:
+                    os.remove(oldest)
+                except OSError:
+                    pass
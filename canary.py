@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Measurements of the canary run ('migrate.py canary').
+ *
+ * A sample of the rooms is migrated into throwaway rooms with an increasing
+ * number of room workers. The requests of every level are timed with a
+ * response hook of the session, the level with the best throughput that is
+ * (almost) not rate limited is recommended.
+'''
+
+import threading
+from utils import print
+
+# rooms are sampled from the small, the medium and the big rooms of the export
+bucketNames = ["small", "medium", "large"]
+
+def sample_rooms(jobs, perBucket):
+    '''perBucket rooms spread over each third of the rooms ordered by size'''
+    jobs = sorted((job for job in jobs if job["bytes"]), key=lambda job: job["bytes"])
+    sample = []
+    for bucket in range(len(bucketNames)):
+        members = jobs[bucket * len(jobs) // len(bucketNames):(bucket + 1) * len(jobs) // len(bucketNames)]
+        count = min(perBucket, len(members))
+        for i in range(count):
+            job = members[(2 * i + 1) * len(members) // (2 * count)]
+            sample.append(dict(job, bucket=bucketNames[bucket]))
+    return sample
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class RequestStats(object):
+    '''latency and rate limiting of the requests of a session, by kind of request'''
+
+    kinds = [("send", "/send/"), ("upload", "/upload"), ("join", "/join"), ("create", "/createRoom")]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.throttled = {}
+
+    def response(self, r, *args, **kwargs):
+        # response hook of requests
+        kind = next((kind for kind, path in self.kinds if path in r.url), None)
+        if kind is None:
+            return
+        with self.lock:
+            self.latency.setdefault(kind, []).append(r.elapsed.total_seconds())
+            if r.status_code == 429:
+                self.throttled[kind] = self.throttled.get(kind, 0) + 1
+
+    def count(self, kind):
+        return len(self.latency.get(kind, []))
+
+    def throttled_rate(self):
+        requests = sum(len(latency) for latency in self.latency.values())
+        return sum(self.throttled.values()) / requests if requests else 0.0
+
+    def report(self):
+        for kind, path in self.kinds:
+            latency = self.latency.get(kind)
+            if latency:
+                print("  %-8s %6d requests  p50 %7.1fms  p95 %7.1fms  %5d x 429" % (kind, len(latency), percentile(latency, 0.5) * 1000, percentile(latency, 0.95) * 1000, self.throttled.get(kind, 0)))
+
+def recommend(results, maxThrottled=0.01):
+    '''the result with the best throughput that is hardly rate limited, more
+    workers have to bring at least 10% more throughput, None if nothing
+    was measured'''
+    results = [result for result in results if result["rate"] > 0]
+    if not results:
+        return None
+    best = None
+    for result in results:
+        if result["throttled"] > maxThrottled:
+            break
+        if best is None or result["rate"] > best["rate"] * 1.1:
+            best = result
+    return best or results[0]
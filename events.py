@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from memory import eventOverhead, message_memory
+from utils import print
+
+# Slack user id -> small integer, shared by all rooms
+userIndex = {}
+userIndexLock = threading.Lock()
+
+def event_key(user, ts):
+    '''compact key for a Slack message: interned user index and integer ts'''
+    index = userIndex.get(user)
+    if index is None:
+        with userIndexLock:
+            index = userIndex.setdefault(user, len(userIndex))
+    # ts is "<seconds>.<6 digits>" which fits into 56 bits as an integer
+    return (index << 56) | int(ts.replace(".", ""))
+
+class ThreadStore(object):
+    '''LRU store for the reply fallbacks of thread parents, capped at maxBytes
+    of fallback text'''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def entry_size(self, entry):
+        return len(entry["text"]) + len(entry["html"])
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self.size -= self.entry_size(self.entries.pop(key))
+        self.entries[key] = entry
+        self.size += self.entry_size(entry)
+
+        # drop the least recently used parents until we fit again
+        while self.size > self.maxBytes and len(self.entries) > 1:
+            _key, _entry = self.entries.popitem(last=False)
+            self.size -= self.entry_size(_entry)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+class RoomEvents(object):
+    '''event maps of a single room, dropped once the room is migrated
+
+    eventLUT: message key -> matrix event id
+    replyLUT: message key -> key of the message it replies to
+    threadLUT: message key -> reply fallback of a thread parent (see ThreadStore)
+    later: thread replies seen before their parent
+    migrated: (sender, ts) -> event of the messages earlier runs sent to the
+        room, read from the homeserver when a thread goes on (delta mode)
+    reactionQueue: sends reactions next to the messages of the room
+
+    Postponed messages and queued reactions count against config["memory"].
+    '''
+
+    def __init__(self, config):
+        self.eventLUT = {}
+        self.replyLUT = {}
+        self.threadLUT = ThreadStore(config["thread-store-size"])
+        self.later = []
+        self.laterSize = 0
+        self.migrated = None
+        self.memory = config["memory"]
+        self.tracer = config["tracer"]
+        self.reactionQueue = ThreadPoolExecutor(max_workers=config["reaction-workers"])
+
+    def postpone(self, message):
+        size = message_memory(message)
+        self.memory.acquire(size, block=False)
+        self.laterSize += size
+        self.later.append(message)
+
+    def queue_reaction(self, func, *args):
+        # reactions don't need timeline order, so they don't hold up the next message
+        self.memory.account(eventOverhead)
+        future = self.reactionQueue.submit(self.tracer.carry(self.send_reaction), func, *args)
+        future.add_done_callback(self.reaction_done)
+
+    def send_reaction(self, func, *args):
+        with self.tracer.span("reaction", "message"):
+            return func(*args)
+
+    def reaction_done(self, future):
+        self.memory.account(-eventOverhead)
+        report_failure(future)
+
+    def close(self):
+        # wait for the queued reactions of the room
+        self.reactionQueue.shutdown(wait=True)
+        self.memory.release(self.laterSize)
+        self.laterSize = 0
+
+def report_failure(future):
+    if future.exception():
+        print("ERROR while sending reaction: " + str(future.exception()))
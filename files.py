@@ -13,10 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
-import slackdown
-from utils import send_event, print
-from emoji import emojize
+import threading
+from concurrent.futures import Future
+from utils import send_event, make_txn_id, record_error, dead_letter, dead_letter_event, print
+from thumbnails import make_thumbnail
 
 '''
  * Converts a slack image attachment to a matrix image event.
@@ -35,10 +35,11 @@ from emoji import emojize
  *     wide thumbnail of the file, if an image.
  * @param {string} url The matrix file mxc.
  * @param {?string} thumbnail_url The matrix thumbnail mxc.
+ * @param {?Object} thumbnail_info info of a thumbnail made locally.
  * @return {Object} Matrix event content, as per https://matrix.org/docs/spec/#m-image
 '''
 
-def slackImageToMatrixImage(file, url, thumbnailUrl):
+def slackImageToMatrixImage(file, url, thumbnailUrl, thumbnailInfo=None):
     message = {
         "body": file["title"],
         "info": {
@@ -56,7 +57,10 @@ def slackImageToMatrixImage(file, url, thumbnailUrl):
     if "original_h" in file:
         message["info"]["h"] = file["original_h"]
 
-    if thumbnailUrl:
+    if thumbnailUrl and thumbnailInfo:
+        message["thumbnail_url"] = thumbnailUrl
+        message["thumbnail_info"] = thumbnailInfo
+    elif thumbnailUrl:
         message["thumbnail_url"] = thumbnailUrl
         message["thumbnail_info"] = {}
         if "thumb_360_w" in file:
@@ -78,10 +82,11 @@ def slackImageToMatrixImage(file, url, thumbnailUrl):
  * @param file.original_h height of the file if an image, in pixels.
  * @param url The matrix file mxc.
  * @param thumbnail_url The matrix thumbnail mxc.
+ * @param thumbnail_info info of a thumbnail made locally.
  * @return Matrix event content, as per https://matrix.org/docs/spec/client_server/r0.4.0.html#m-video
 '''
 
-def slackImageToMatrixVideo(file, url, thumbnailUrl):
+def slackImageToMatrixVideo(file, url, thumbnailUrl, thumbnailInfo=None):
     message = {
         "body": file["title"],
         "info": {
@@ -103,6 +108,8 @@ def slackImageToMatrixVideo(file, url, thumbnailUrl):
     if thumbnailUrl:
         message["thumbnail_url"] = thumbnailUrl
         # Slack don't tell us the thumbnail size for videos. Boo
+        if thumbnailInfo:
+            message["thumbnail_info"] = thumbnailInfo
 
     return message
 
@@ -134,15 +141,16 @@ def slackImageToMatrixAudio(file, url):
  * @param file The slack file object.
  * @param url The matrix file mxc.
  * @param thumbnail_url The matrix thumbnail mxc.
+ * @param thumbnail_info info of a thumbnail made locally.
  * @return Matrix event content, as per https://matrix.org/docs/spec/#m-file
 '''
 
-def slackFileToMatrixMessage(file, url, thumbnailUrl):
+def slackFileToMatrixMessage(file, url, thumbnailUrl, thumbnailInfo=None):
     if "mimetype" in file:
         if file["mimetype"].startswith("image/"):
-            return slackImageToMatrixImage(file, url, thumbnailUrl)
+            return slackImageToMatrixImage(file, url, thumbnailUrl, thumbnailInfo)
         if file["mimetype"].startswith("video/"):
-                return slackImageToMatrixVideo(file, url, thumbnailUrl)
+                return slackImageToMatrixVideo(file, url, thumbnailUrl, thumbnailInfo)
         if file["mimetype"].startswith("audio/"):
             return slackImageToMatrixAudio(file, url)
 
@@ -156,25 +164,44 @@ def slackFileToMatrixMessage(file, url, thumbnailUrl):
         "url": url,
     }
 
-def uploadContentFromURI(content, uri, config, user):
-    res = requests.get(uri)
+def download(uri, config, fileId=None, variant="original"):
+    # Slack's CDN is rate limited, don't download the same file twice
+    cache = config.get("cache")
+    if cache and fileId:
+        file_content = cache.get(fileId, variant)
+        if file_content is not None:
+            return file_content
+
+    res = config["session"].get(uri)
     if res.status_code != 200:
         print("ERROR! Received %d %s" % (res.status_code, res.reason))
+        record_error(res)
         if 400 <= res.status_code < 500:
             try:
                 print(res.json()["error"])
             except Exception:
                 pass
+        return None
+
+    if cache and fileId:
+        cache.put(fileId, variant, res.content)
+    return res.content
+
+def uploadContentFromURI(content, uri, config, user, fileId=None, variant="original"):
+    file_content = download(uri, config, fileId, variant)
+    if file_content is None:
         return ''
 
-    file_content = res.content
+    return uploadContent(content, file_content, config, user)
 
+def uploadContent(content, file_content, config, user):
     url = "%s/_matrix/media/r0/upload?user_id=%s&filename=%s" % (config["homeserver"],user,content["title"],)
 
-    r = requests.post(url, headers={'Authorization': 'Bearer ' + config["as_token"], 'Content-Type': content["mimetype"]}, data=file_content, verify=False)
+    r = config["session"].post(url, headers={'Authorization': 'Bearer ' + config["as_token"], 'Content-Type': content["mimetype"]}, data=file_content, verify=False)
 
     if r.status_code != 200:
         print("ERROR! Received %d %s" % (r.status_code, r.reason))
+        record_error(r)
         if 400 <= r.status_code < 500:
             try:
                 print(r.json()["error"])
@@ -185,14 +212,12 @@ def uploadContentFromURI(content, uri, config, user):
         return r.json()["content_uri"]
 
 def process_attachments(attachments, roomId, userId, body, txnId, config):
-    for file in attachments:
-        txnId = process_file(file, roomId, userId, body, txnId, config)
-    return txnId
+    for index, file in enumerate(attachments):
+        process_file(file, roomId, userId, body, make_txn_id(txnId, "attachment", index), config)
 
 def process_files(files, roomId, userId, body, txnId, config):
-    for file in files:
-        txnId = process_file(file, roomId, userId, body, txnId, config)
-    return txnId
+    for index, file in enumerate(files):
+        process_file(file, roomId, userId, body, make_txn_id(txnId, "file", index), config)
 
 def get_link(file):
     if file["public_url_shared"]:
@@ -201,19 +226,18 @@ def get_link(file):
         link = file["url_private"]
     return link
 
+def dead_letter_file(file, roomId, userId, body, txnId, config):
+    # replayed with process_file
+    dead_letter(config, "file", roomId, {"file": file.get("id")}, {"file": file, "user": userId, "body": body, "txnId": txnId})
+
 def process_snippet(file, roomId, userId, body, txnId, config, ts):
     htmlString = ""
-    res = requests.get(file["url_private"])
-    if res.status_code != 200:
-        print("ERROR! Received %d %s" % (res.status_code, res.reason))
-        if 400 <= res.status_code < 500:
-            try:
-                print(res.json()["error"])
-            except Exception:
-                pass
-        return txnId
+    snippet = download(file["url_private"], config, file.get("id"))
+    if snippet is None:
+        dead_letter_file(file, roomId, userId, body, txnId, config)
+        return
 
-    htmlString = res.content.decode("utf-8")
+    htmlString = snippet.decode("utf-8")
 
     htmlCode = ""
     # Because escaping 6 backticks is not good for readability.
@@ -239,10 +263,89 @@ def process_snippet(file, roomId, userId, body, txnId, config, ts):
         link = get_link(file)
         print("Could not send snippet: " + link)
         print("Trying to send as file...")
-        txnId = process_upload(file, roomId, userId, body, txnId, config, ts)
-        return txnId
+        process_upload(file, roomId, userId, body, make_txn_id(txnId, "upload"), config, ts)
+
+class Uploads(object):
+    '''Slack file id -> (file uri, thumbnail uri, thumbnail info) of the
+    uploaded files, a file that is being uploaded by one worker is waited
+    for by the others'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def upload(self, fileId, config, upload, *args):
+        with self.lock:
+            entry = self.entries.get(fileId)
+            owner = entry is None
+            if owner:
+                entry = self.entries[fileId] = Future()
+        if not owner:
+            # the memory held meanwhile mustn't hold up the uploading worker
+            with config["memory"].idle():
+                return entry.result()
+
+        uploaded = None
+        try:
+            uploaded = upload(*args)
+        finally:
+            if uploaded is None:
+                # the next worker tries again
+                with self.lock:
+                    del self.entries[fileId]
+            entry.set_result(uploaded)
+        return uploaded
+
+def upload_file(file, userId, config):
+    '''uploads the file and its thumbnail, (file uri, thumbnail uri,
+    thumbnail info) or None if the file could not be uploaded'''
+    # the file is held between download and upload, waits while the memory budget is used up
+    with config["memory"].reserve(file["size"]):
+        thumbUri = ""
+        thumbVariant = ""
+        thumbnailContentUri=""
+        thumbnailInfo = None
+        original = None
+
+        # make the thumbnail from the original, saves downloading Slack's
+        if config.get("local-thumbnails") and file["mimetype"].startswith(("image/", "video/")):
+            original = download(file["url_private"], config, file.get("id"))
+            with config["tracer"].span("thumbnail", "file"):
+                thumbnail = make_thumbnail(original, file["mimetype"]) if original is not None else None
+            if thumbnail:
+                thumbnailData, thumbnailMimetype, width, height = thumbnail
+                content = {
+                    "mimetype": thumbnailMimetype,
+                    "title": file["name"] + "_thumb." + thumbnailMimetype.split("/")[1],
+                }
+                thumbnailContentUri = uploadContent(content, thumbnailData, config, userId)
+                if thumbnailContentUri:
+                    thumbnailInfo = {"w": width, "h": height, "mimetype": thumbnailMimetype, "size": len(thumbnailData)}
+
+        if not thumbnailInfo:
+            if "thumb_video" in file:
+                thumbUri = file["thumb_video"]
+                thumbVariant = "thumb_video"
+            if "thumb_360" in file:
+                thumbUri = file["thumb_360"]
+                thumbVariant = "thumb_360"
+
+        if thumbUri and "filetype" in file:
+            content = {
+                "mimetype": file["mimetype"],
+                "title": file["name"] + '_thumb' + file["filetype"],
+            }
+
+            thumbnailContentUri = uploadContentFromURI(content, thumbUri, config, userId, file.get("id"), thumbVariant)
 
-    return txnId
+        if original is not None:
+            fileContentUri = uploadContent({"title": file["title"], "mimetype": file["mimetype"]}, original, config, userId)
+        else:
+            fileContentUri = uploadContentFromURI({"title": file["title"], "mimetype": file["mimetype"]}, file["url_private"], config, userId, file.get("id"))
+        if not fileContentUri:
+            return None
+
+        return fileContentUri, thumbnailContentUri, thumbnailInfo
 
 def process_upload(file, roomId, userId, body, txnId, config, ts):
     if "maxUploadSize" in config and file["size"] > config["maxUploadSize"]:
@@ -257,46 +360,35 @@ def process_upload(file, roomId, userId, body, txnId, config, ts):
         res = send_event(config, messageContent, roomId, userId, "m.room.message", txnId, ts)
         if res == False:
             print("ERROR while sending file link to room '" + roomId)
+            dead_letter_event(config, {"file": file.get("id")}, messageContent, roomId, userId, "m.room.message", txnId, ts)
 
     else:
-        thumbUri = ""
-        thumbnailContentUri=""
-
-        if "thumb_video" in file:
-            thumbUri = file["thumb_video"]
-        if "thumb_360" in file:
-            thumbUri = file["thumb_360"]
-
-        if thumbUri and "filetype" in file:
-            content = {
-                "mimetype": file["mimetype"],
-                "title": file["name"] + '_thumb' + file["filetype"],
-            }
-
-            thumbnailContentUri = uploadContentFromURI(content, thumbUri, config, userId)
-
-        fileContentUri = uploadContentFromURI({"title": file["title"], "mimetype": file["mimetype"]}, file["url_private"], config, userId)
-
-        messageContent = slackFileToMatrixMessage(file, fileContentUri, thumbnailContentUri)
+        # a file shared in several channels or exports is uploaded once
+        if file.get("id"):
+            uploaded = config["uploads"].upload(file["id"], config, upload_file, file, userId, config)
+        else:
+            uploaded = upload_file(file, userId, config)
+        if uploaded is None:
+            print("ERROR while uploading file " + file["title"])
+            dead_letter_file(file, roomId, userId, body, txnId, config)
+            return
+
+        messageContent = slackFileToMatrixMessage(file, *uploaded)
 
         res = send_event(config, messageContent, roomId, userId, "m.room.message", txnId, ts)
         if res == False:
             print("ERROR while sending file to room '" + roomId)
-
-    txnId = txnId + 1
-    return txnId
+            dead_letter_event(config, {"file": file.get("id")}, messageContent, roomId, userId, "m.room.message", txnId, ts)
 
 def process_file(file, roomId, userId, body, txnId, config):
     if not "url_private" in file:
         # we have no url to process the file
-        return txnId
+        return
 
     ts = str(file["timestamp"]) + "000"
 
-    if file["mode"] == "snippet":
-        txnId = process_snippet(file, roomId, userId, body, txnId, config, ts)
-    else:
-        txnId = process_upload(file, roomId, userId, body, txnId, config, ts)
-
-    txnId = txnId + 1
-    return txnId
+    with config["tracer"].span("file", "file", mode=file["mode"], size=file.get("size", 0)):
+        if file["mode"] == "snippet":
+            process_snippet(file, roomId, userId, body, txnId, config, ts)
+        else:
+            process_upload(file, roomId, userId, body, txnId, config, ts)
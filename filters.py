@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Selection of the part of the export to migrate.
+ *
+ * config["channels"]          globs of channel names to migrate (all if empty)
+ * config["exclude-channels"]  globs of channel names to leave out
+ * config["dms"]               migrate direct messages
+ * config["since"]             first day to migrate, "YYYY-MM-DD"
+ * config["until"]             last day to migrate, "YYYY-MM-DD"
+ * config["day-files"]         day files to migrate ("channel/YYYY-MM-DD.json") -> ts (in
+ *                             ms, as sent) of their messages to migrate or None for all,
+ *                             e.g. the gaps found by 'verify', None for all day files
+ *
+ * Days are selected by the name of the day files, excluded day files are
+ * never read from the export.
+'''
+
+import fnmatch
+import os
+
+def channel_selected(config, name):
+    if config["channels"] and not any(fnmatch.fnmatchcase(name, glob) for glob in config["channels"]):
+        return False
+    return not any(fnmatch.fnmatchcase(name, glob) for glob in config["exclude-channels"])
+
+def read_day_files(filename):
+    # one day file per line, optionally followed by the ts of the messages to
+    # migrate from it, lines starting with # are comments
+    dayFiles = {}
+    with open(filename, "r") as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            dayFiles[parts[0]] = set(int(ts) for ts in parts[1:]) or None
+    return dayFiles
+
+def day_selected(config, file):
+    if config["day-files"] is not None and not file in config["day-files"]:
+        return False
+    # "channel/2020-01-31.json" -> "2020-01-31", the ISO dates compare as strings
+    day = os.path.splitext(os.path.basename(file))[0]
+    if config["since"] and day < config["since"]:
+        return False
+    if config["until"] and day > config["until"]:
+        return False
+    return True
+
+def job_selected(config, job):
+    if job["is_dm"]:
+        return config["dms"]
+    return channel_selected(config, job["folder"])
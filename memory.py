@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Memory budget shared by all workers of a migration (config["memory-budget"]).
+ *
+ * Parsed day files, media between download and upload and postponed or
+ * queued events are counted against it. Reading the next day file and
+ * downloading the next file wait while the budget is used up.
+ *
+ * A worker only waits as long as another worker that isn't waiting itself
+ * still holds memory, it will free it eventually. If every worker holding
+ * memory is waiting, one of them goes over the budget instead of blocking
+ * the migration forever.
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+
+# parsed JSON takes several times the bytes of the file
+parsedFactor = 5
+
+# a queued or postponed event besides its text
+eventOverhead = 512
+
+def day_file_memory(sizes):
+    '''the raw day files of a batch plus the largest one parsed'''
+    return sum(sizes) + max(sizes, default=0) * parsedFactor
+
+def message_memory(message):
+    return len(message.get("text", "")) + eventOverhead
+
+class MemoryBudget(object):
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.condition = threading.Condition()
+        self.used = 0
+        # bytes held by workers that are waiting themselves
+        self.waiting = 0
+        self.held = threading.local()
+        self.peak = 0
+        self.waited = 0.0
+
+    def holding(self):
+        return getattr(self.held, "size", 0)
+
+    def acquire(self, size, block=True):
+        '''take size bytes for the calling thread, waits while the budget is
+        used up unless block is False'''
+        with self.condition:
+            if block and self.used + size > self.maxBytes and self.used > self.waiting + self.holding():
+                start = time.time()
+                self.waiting += self.holding()
+                # a new waiter may leave nobody running that could free memory
+                self.condition.notify_all()
+                while self.used + size > self.maxBytes and self.used > self.waiting:
+                    self.condition.wait()
+                self.waiting -= self.holding()
+                self.waited += time.time() - start
+            self.used += size
+            self.held.size = self.holding() + size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.held.size = self.holding() - size
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, size, block=True):
+        self.acquire(size, block)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    @contextmanager
+    def idle(self):
+        '''the calling thread waits for another worker, its memory counts as
+        waiting meanwhile'''
+        with self.condition:
+            self.waiting += self.holding()
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.waiting -= self.holding()
+
+    def account(self, size):
+        '''count bytes that are freed by another thread (negative size), like
+        queued reactions, they never wait'''
+        with self.condition:
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            if size < 0:
+                self.condition.notify_all()
+
+    def report(self):
+        return "Memory budget: peak %d of %d bytes, waited %.1fs for memory" % (self.peak, self.maxBytes, self.waited)
@@ -16,98 +16,72 @@
 # limitations under the License.
 
 from __future__ import print_function
+import argparse
+import copy
 import logging
 import os
 import sys
-import yaml
-import zipfile
-import requests
 import json
 import getpass
+import importlib.util
+import html
 import string
 import secrets
 import time
-from emoji import emojize
-import slackdown
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
-from files import process_attachments, process_files
-from utils import send_event, print
-
+from files import process_attachments, process_files, process_file, Uploads
+from cache import ContentCache
+from memory import MemoryBudget, day_file_memory
+from tracing import Tracer
+from events import RoomEvents, event_key
+from sources import open_source, zstdSuffixes
+from filters import channel_selected, job_selected, read_day_files
+from canary import sample_rooms, recommend, RequestStats
+from thumbnails import have_pillow, have_ffmpeg
+from schedule import room_job, order_rooms, shard_jobs, record, snapshot
+from state import open_state, State
+from users import UserDirectory
+from utils import send_event, make_txn_id, record_error, dead_letter, dead_letter_event, last_error, capture_dead_letters, json_loads, print, log_to, lazy_import, requests
+
+# only loaded by the commands that need them
+yaml = lazy_import("yaml")
+emoji = lazy_import("emoji")
+slackdown = lazy_import("slackdown")
+
+# TODO migrate file_comments
+ignoredSubtypes = ["bot_message", "bot_remove", "slackbot_response", "channel_name", "channel_join", "channel_purpose", "group_name", "group_join", "group_purpose", "file_comment"]
 
 channelTypes = ["dms.json", "groups.json", "mpims.json", "channels.json", "users.json"]
-userLUT = {}
-nameLUT = {}
-roomLUT = {}
-roomLUT2 = {}
-dmLUT = {}
-eventLUT = {}
-threadLUT = {}
-replyLUT = {}
-later = []
-read_luts = False
-
-if not os.path.isfile("config.yaml"):
-    print("Config file does not exist.")
-    sys.exit(1)
-
-f = open("config.yaml", "r")
-config_yaml = yaml.load(f.read(), Loader=yaml.FullLoader)
-
-# load luts from previous run
-if os.path.isfile("luts.yaml"):
-    f = open("luts.yaml", "r")
-    luts = yaml.load(f.read(), Loader=yaml.FullLoader)
-    userLUT = luts["userLUT"]
-    nameLUT = luts["nameLUT"]
-    roomLUT = luts["roomLUT"]
-    roomLUT2 = luts["roomLUT2"]
-    dmLUT = luts["dmLUT"]
-    read_luts = True
-
-def test_config(yaml):
-    if not config_yaml["zipfile"]:
-        print("No zipfile defined in config")
-        sys.exit(1)
 
-    if not config_yaml["homeserver"]:
-        print("No homeserver defined in config")
-        sys.exit(1)
+class MigrationError(Exception):
+    '''a migration can't go on, e.g. the config is incomplete or the admin
+    user can't log in; the script prints it and exits'''
 
-    if not config_yaml["as_token"]:
-        print("No Application Service token defined in config")
-        sys.exit(1)
+def load_config(filename):
+    if not os.path.isfile(filename):
+        raise MigrationError("Config file does not exist.")
 
-    dry_run = config_yaml["dry-run"]
-    skip_archived = config_yaml["skip-archived"]
-
-    config = { "zipfile": config_yaml["zipfile"], "dry-run": dry_run, "homeserver": config_yaml["homeserver"], "skip-archived": skip_archived, "as_token": config_yaml["as_token"], "skip-files": config_yaml["skip-files"]}
-
-    return config
+    with open(filename, "r") as f:
+        return yaml.load(f.read(), Loader=yaml.FullLoader)
 
 def loadZip(config):
     zipName = config["zipfile"]
-    print("Opening zipfile: " + zipName)
-    archive = zipfile.ZipFile(zipName, 'r')
+    print("Opening export: " + zipName)
+    # zip file, extracted directory or tar archive, see sources.py
+    config["source"] = open_source(zipName)
     jsonFiles = {}
     for channelType in channelTypes:
-        try:
-            jsonFiles[channelType] = archive.open(channelType)
+        jsonFile = config["source"].open_metadata(channelType)
+        if jsonFile is not None:
+            jsonFiles[channelType] = jsonFile
             print("Found " + channelType + " in archive. Adding.")
-        except:
+        else:
             print("Warning: Couldn't find " + channelType + " in archive. Skipping.")
     return jsonFiles
 
 def loadZipFolder(config, folder):
-    with zipfile.ZipFile(config["zipfile"], 'r') as file:
-        archive = file.infolist()
-
-        fileList = []
-        for entry in archive:
-            file_basename = entry.filename.split("/", maxsplit=1)[0]
-            if entry.is_dir() == False and folder == file_basename:
-                fileList.append(entry.filename)
-
-        return fileList
+    return config["source"].list_folder(folder)
 
 # update_progress() : Displays or updates a console progress bar
 ## Accepts a float between 0 and 1. Any int will be converted to a float.
@@ -132,151 +106,260 @@ def update_progress(progress):
     sys.stdout.write(text)
     sys.stdout.flush()
 
-def login(server_location):
-    try:
-        default_user = getpass.getuser()
-    except Exception:
-        default_user = None
+def send_reaction(config, roomId, eventId, reactionKey, userId, txnId):
 
-    if default_user:
-        admin_user = input("Admin user localpart [%s]: " % (default_user,))
-        if not admin_user:
-            admin_user = default_user
-    else:
-        admin_user = input("Admin user localpart: ")
+    content = {
+        "m.relates_to": {
+            "event_id": eventId,
+            "key": reactionKey,
+            "rel_type": "m.annotation",
+        },
+    }
 
-    if not admin_user:
-        print("Invalid user name")
-        sys.exit(1)
+    res = send_event(config, content, roomId, userId, "m.reaction", txnId)
+    if res == False:
+        dead_letter_event(config, {"event_id": eventId, "key": reactionKey}, content, roomId, userId, "m.reaction", txnId)
 
-    admin_password = getpass.getpass("Password: ")
+    return res
 
-    if not admin_password:
-        print("Password cannot be blank.")
-        sys.exit(1)
+def truncate(text, maxLength):
+    if not maxLength or len(text) <= maxLength:
+        return text
+    # the mention links of replace_mention can't be cut in half, keep only
+    # their display name, any other <...> is text of the message
+    text = re.sub(r"<a href='https://matrix\.to/#/[^']*'>(.*?)</a>", r'\1', text)
+    if len(text) <= maxLength:
+        return text
+    return text[:maxLength] + "…"
+
+def getFallbackHtml(roomId, replyEvent, maxLength=0):
+    originalBody = replyEvent["body"]
+    originalHtml = replyEvent["formatted_body"]
+    if not replyEvent["body"]:
+        originalHtml = originalBody
+    elif maxLength and len(originalBody) > maxLength:
+        # the html can't be cut anywhere either, quote the shortened text instead;
+        # the Slack text already has entities (&gt; of quotes), escape them once
+        originalHtml = html.escape(truncate(html.unescape(originalBody), maxLength)).replace("\n", "<br />")
 
-    url = "%s/_matrix/client/r0/login" % (server_location,)
-    data = {
-        "type": "m.login.password",
-        "user": admin_user,
-        "password": admin_password,
-    }
+    return '<mx-reply><blockquote><a href="https://matrix.to/#/' + roomId + '/' + replyEvent["event_id"] + '">In reply to</a><a href="https://matrix.to/#/' + replyEvent["sender"] + '">' + replyEvent["sender"] + '</a><br />' + originalHtml + '</blockquote></mx-reply>'
 
-    # Get the access token
-    r = requests.post(url, json=data, verify=False)
+def getFallbackText(replyEvent, maxLength=0):
+    originalBody = truncate(replyEvent["body"], maxLength)
+    originalBody = originalBody.split("\n")
+    originalBody = "\n> ".join(originalBody)
+    return '> <' + replyEvent["sender"] + '> ' + originalBody
 
-    if r.status_code != 200:
-        print("ERROR! Received %d %s" % (r.status_code, r.reason))
-        if 400 <= r.status_code < 500:
-            try:
-                print(r.json()["error"])
-            except Exception:
-                pass
+def ts_key(ts):
+    # Slack ts values are "<seconds>.<6 digit counter>", compare them as integers
+    return int(ts.replace(".", ""))
+
+def before_since(config, ts):
+    # the day of a message, in UTC like the day files of the export
+    return bool(config["since"]) and time.strftime("%Y-%m-%d", time.gmtime(float(ts))) < config["since"]
+
+def skip_day_file(file, watermark):
+    # day files are named after their date ("channel/2020-01-31.json"), skip
+    # every file that is at least a full day older than the watermark so
+    # timezone differences between the export and the ts can't drop messages
+    if not watermark:
         return False
+    day = os.path.splitext(os.path.basename(file))[0]
+    watermarkDay = time.strftime("%Y-%m-%d", time.gmtime(float(watermark) - 86400))
+    return day < watermarkDay
+
+class lazy_lut(object):
+    '''a LUT of the state, read from the state file when a Migrator uses it
+    for the first time and kept as attribute of the Migrator from then on'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, migrator, owner):
+        if migrator is None:
+            return self
+        lut = migrator.state.load(self.name)
+        migrator.__dict__[self.name] = lut
+        return lut
+
+class Migrator(object):
+    '''the migration of one Slack export
+
+    Everything a migration works with is kept here, so several exports can
+    be migrated concurrently in one process and driven by other code:
+
+        migrator = Migrator(load_config("config.yaml"), open_state("luts.db"))
+        migrator.migrate()
+
+    config_yaml     the parsed config file
+    state           State of the migration, see state.py
+    session         requests.Session to talk to the homeserver and Slack, can
+                    be shared between migrators to reuse its connections
+    cache           ContentCache of the Slack downloads, can be shared as well
+    memory          MemoryBudget of the workers, see memory.py
+    users           UserDirectory of the registered users, migrators sharing
+                    it register a Slack user in several exports only once
+    uploads         Uploads of the Slack files, see files.py, shared files of
+                    several exports are uploaded once
+    admin_user      localpart and password of the admin user, asked for on
+    admin_password  the terminal if not given
+
+    See open_exports() for migrators of several exports sharing all of them.
+    '''
+
+    userLUT = lazy_lut("userLUT")
+    nameLUT = lazy_lut("nameLUT")
+    roomLUT = lazy_lut("roomLUT")
+    roomLUT2 = lazy_lut("roomLUT2")
+    dmLUT = lazy_lut("dmLUT")
+    watermarkLUT = lazy_lut("watermarkLUT")
+    scheduleStats = lazy_lut("scheduleStats")
+
+    def __init__(self, config_yaml, state, session=None, cache=None, memory=None, users=None, uploads=None, admin_user=None, admin_password=None):
+        self.config_yaml = config_yaml
+        self.admin_user = admin_user
+        self.admin_password = admin_password
+        # of the admin user, set by connect()
+        self.access_token = None
+
+        # LUTs of previous runs, see lazy_lut
+        self.state = state
+        self.read_luts = not state.is_empty()
+        # users registered by this run
+        self.userlist = []
+        # see failed_users()
+        self.failedUsers = None
+        self.users = users or UserDirectory()
+
+        self.config = self.test_config()
+        if cache is not None:
+            self.config["cache"] = cache
+        if memory is not None:
+            self.config["memory"] = memory
+        if uploads is not None:
+            self.config["uploads"] = uploads
+        self.use_session(session or self.new_session())
+
+    def use_session(self, session):
+        self.session = session
+        self.config["session"] = session
+        if self.config["tracer"].enabled:
+            session.hooks["response"].append(self.config["tracer"].response)
+
+    def new_session(self, roomWorkers=None):
+        # enough pooled connections for all workers sending at the same time
+        roomWorkers = roomWorkers or self.config["room-workers"]
+        poolSize = max(10, self.config["provision-workers"], roomWorkers * (1 + self.config["reaction-workers"]))
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=poolSize)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def test_config(self):
+        if not self.config_yaml["zipfile"]:
+            raise MigrationError("No zipfile defined in config")
+
+        if not self.config_yaml["homeserver"]:
+            raise MigrationError("No homeserver defined in config")
+
+        if not self.config_yaml["as_token"]:
+            raise MigrationError("No Application Service token defined in config")
+
+        if self.config_yaml["zipfile"].endswith(zstdSuffixes):
+            if importlib.util.find_spec("zstandard") is None:
+                raise MigrationError("Reading zstd compressed exports requires the zstandard package")
+
+        dry_run = self.config_yaml["dry-run"]
+        skip_archived = self.config_yaml["skip-archived"]
+
+        delta = self.config_yaml.get("delta", False)
+        # bytes of thread parent text kept per room for reply fallbacks
+        thread_store_size = self.config_yaml.get("thread-store-size", 16 * 1024 * 1024)
+        reply_fallback_length = self.config_yaml.get("reply-fallback-length", 500)
+        reaction_workers = self.config_yaml.get("reaction-workers", 4)
+        provision_workers = self.config_yaml.get("provision-workers", 8)
+        room_workers = self.config_yaml.get("room-workers", 1)
+
+        # part of the export to migrate, see filters.py
+        since = self.config_yaml.get("since")
+        until = self.config_yaml.get("until")
+        selection = {
+            "channels": self.config_yaml.get("channels") or [],
+            "exclude-channels": self.config_yaml.get("exclude-channels") or [],
+            "dms": self.config_yaml.get("dms", True),
+            # yaml reads unquoted dates as datetime.date
+            "since": str(since) if since else None,
+            "until": str(until) if until else None,
+            "day-files": read_day_files(self.config_yaml["day-files"]) if self.config_yaml.get("day-files") else None,
+        }
 
-    access_token = r.json()["access_token"]
+        config = { "zipfile": self.config_yaml["zipfile"], "dry-run": dry_run, "homeserver": self.config_yaml["homeserver"], "skip-archived": skip_archived, "as_token": self.config_yaml["as_token"], "skip-files": self.config_yaml["skip-files"], "delta": delta, "thread-store-size": thread_store_size, "reply-fallback-length": reply_fallback_length, "reaction-workers": reaction_workers, "provision-workers": provision_workers, "room-workers": room_workers}
+        config.update(selection)
 
-    return admin_user, access_token
+        # failed operations are kept there for 'redrive'
+        config["state"] = self.state
 
-def getMaxUploadSize(config, access_token):
-    # get maxUploadSize from Homeserver
-    url = "%s/_matrix/media/r0/config?access_token=%s" % (config_yaml["homeserver"],access_token,)
-    r = requests.get(url, verify=False)
+        # thumbnails made from the original instead of downloaded from Slack
+        config["local-thumbnails"] = self.config_yaml.get("local-thumbnails", False)
+        if config["local-thumbnails"] and not have_pillow():
+            print("Warning: local-thumbnails needs Pillow for images, their thumbnails are downloaded from Slack")
+        if config["local-thumbnails"] and not have_ffmpeg():
+            print("Warning: local-thumbnails needs ffmpeg for videos, their thumbnails are downloaded from Slack")
 
-    if r.status_code != 200:
-        print("ERROR! Received %d %s" % (r.status_code, r.reason))
-        if 400 <= r.status_code < 500:
-            try:
-                print(r.json()["error"])
-            except Exception:
-                pass
-
-    maxUploadSize = r.json()["m.upload.size"]
-    return maxUploadSize
-
-def register_user(
-    user,
-    password,
-    displayname,
-    server_location,
-    access_token,
-    admin=False,
-    user_type=None,
-):
-
-    url = "%s/_synapse/admin/v2/users/@%s:%s" % (server_location, user, config_yaml['domain'])
-
-    headers = {'Authorization': ' '.join(['Bearer', access_token])}
-
-    data = {
-        "password": password,
-        "displayname": "".join([user, config_yaml["name-suffix"]]),
-        "admin": admin,
-    }
+        # parsed day files, media and queued events of all workers
+        config["memory"] = MemoryBudget(self.config_yaml.get("memory-budget", 1024 * 1024 * 1024))
 
-    r = requests.put(url, json=data, headers=headers, verify=False)
+        # spans of the rooms and a sample of the messages, see tracing.py
+        config["tracer"] = Tracer(self.config_yaml.get("trace-file"), self.config_yaml.get("trace-sample-rate", 0.01))
 
-    if r.status_code != 200 and r.status_code != 201:
-        print("ERROR! Received %d %s" % (r.status_code, r.reason))
-        if 400 <= r.status_code < 500:
-            try:
-                print(r.json()["error"])
-            except Exception:
-                pass
-        return False
+        # files shared in several channels (or exports) are uploaded once
+        config["uploads"] = Uploads()
 
-    return r
-
-def register_room(
-    name,
-    creator,
-    topic,
-    invitees,
-    preset,
-    server_location,
-    as_token,
-):
-    # register room
-    url = "%s/_matrix/client/r0/createRoom?user_id=%s" % (server_location,creator,)
-
-    body = {
-        "preset": preset,
-        "visibility": "public",
-        "name": "".join([name, config_yaml["room-suffix"]]),
-        "room_alias_name": name,
-        "topic": topic,
-        "creation_content": {
-            "m.federate": config_yaml["federate-rooms"]
-        },
-        "invite": invitees,
-        "is_direct": True if preset == "trusted_private_chat" else False,
-    }
+        # downloads from Slack, kept for retries and restarts
+        if self.config_yaml.get("cache-dir"):
+            config["cache"] = ContentCache(self.config_yaml["cache-dir"], self.config_yaml.get("cache-size", 1024 * 1024 * 1024))
 
-    #_print("Sending registration request...")
-    r = requests.post(url, headers={'Authorization': 'Bearer ' + as_token}, json=body, verify=False)
+        return config
 
-    if r.status_code != 200:
-        print("ERROR! Received %d %s" % (r.status_code, r.reason))
-        if 400 <= r.status_code < 500:
-            try:
-                print(r.json()["error"])
-            except Exception:
-                pass
-        return False
+    def ask_admin(self):
+        '''localpart and password of the admin user, asked for if not given'''
+        try:
+            default_user = getpass.getuser()
+        except Exception:
+            default_user = None
+
+        if self.admin_user:
+            admin_user = self.admin_user
+        elif default_user:
+            admin_user = input("Admin user localpart [%s]: " % (default_user,))
+            if not admin_user:
+                admin_user = default_user
+        else:
+            admin_user = input("Admin user localpart: ")
 
-    return r
+        if not admin_user:
+            raise MigrationError("Invalid user name")
 
-def autojoin_users(
-    invitees,
-    roomId,
-    config,
-):
-    for user in invitees:
-        #POST /_matrix/client/r0/rooms/{roomId}/join
-        url = "%s/_matrix/client/r0/rooms/%s/join?user_id=%s" % (config["homeserver"],roomId,user,)
+        admin_password = self.admin_password or getpass.getpass("Password: ")
 
-        #_print("Sending registration request...")
-        r = requests.post(url, headers={'Authorization': 'Bearer ' + config["as_token"]}, verify=False)
+        if not admin_password:
+            raise MigrationError("Password cannot be blank.")
+
+        return admin_user, admin_password
+
+    def login(self, server_location):
+        admin_user, admin_password = self.ask_admin()
+
+        url = "%s/_matrix/client/r0/login" % (server_location,)
+        data = {
+            "type": "m.login.password",
+            "user": admin_user,
+            "password": admin_password,
+        }
+
+        # Get the access token
+        r = self.session.post(url, json=data, verify=False)
 
         if r.status_code != 200:
             print("ERROR! Received %d %s" % (r.status_code, r.reason))
@@ -285,93 +368,331 @@ def autojoin_users(
                     print(r.json()["error"])
                 except Exception:
                     pass
+            return False
 
-def migrate_users(userFile, config, access_token):
-    userlist = []
-    userData = json.load(userFile)
-    for user in userData:
-        if user["is_bot"] == True:
-            continue
+        access_token = r.json()["access_token"]
 
-        # ignore slackbot
-        if user["id"] == "USLACKBOT":
-            continue
+        return admin_user, access_token
 
-        _servername = config["homeserver"].split('/')[2]
-        _matrix_user = user["name"]
-        _matrix_id = '@' + user["name"] + ':' + config_yaml["domain"]
+    def getMaxUploadSize(self, config, access_token):
+        # get maxUploadSize from Homeserver
+        url = "%s/_matrix/media/r0/config?access_token=%s" % (self.config_yaml["homeserver"],access_token,)
+        r = self.session.get(url, verify=False)
 
-        # check if display name is set
-        if "real_name" in user["profile"]:
-            _real_name = user["profile"]["real_name"]
-        else:
-            _real_name = ""
+        if r.status_code != 200:
+            print("ERROR! Received %d %s" % (r.status_code, r.reason))
+            if 400 <= r.status_code < 500:
+                try:
+                    print(r.json()["error"])
+                except Exception:
+                    pass
 
-        # check if email is set
-        if "email" in user["profile"]:
-            _email = user["profile"]["email"]
-        else:
-            _email = ""
-
-        # generate password
-        _alphabet = string.ascii_letters + string.digits
-        _password = ''.join(secrets.choice(_alphabet) for i in range(20)) # for a 20-character password
-
-        userDetails = {
-            "slack_id": user["id"],
-            "slack_team_id": user["team_id"],
-            "slack_name": user["name"],
-            "slack_real_name": _real_name,
-            "slack_email": _email,
-            "matrix_id": _matrix_id,
-            "matrix_user": _matrix_user,
-            "matrix_password": _password,
+        maxUploadSize = r.json()["m.upload.size"]
+        return maxUploadSize
+
+    def register_user(self,
+        user,
+        password,
+        displayname,
+        server_location,
+        access_token,
+        admin=False,
+        user_type=None,
+    ):
+
+        url = "%s/_synapse/admin/v2/users/@%s:%s" % (server_location, user, self.config_yaml['domain'])
+
+        headers = {'Authorization': ' '.join(['Bearer', access_token])}
+
+        data = {
+            "password": password,
+            "displayname": "".join([user, self.config_yaml["name-suffix"]]),
+            "admin": admin,
         }
 
-        print("Registering Slack user " + userDetails["slack_id"] + " -> " + userDetails["matrix_id"])
-        if not config["dry-run"]:
-            res = register_user(userDetails["matrix_user"], userDetails["matrix_password"], userDetails["slack_real_name"], config["homeserver"], access_token)
-            if res == False:
-                print("ERROR while registering user '" + userDetails["matrix_id"] + "'")
+        r = self.session.put(url, json=data, headers=headers, verify=False)
+
+        if r.status_code != 200 and r.status_code != 201:
+            print("ERROR! Received %d %s" % (r.status_code, r.reason))
+            record_error(r)
+            if 400 <= r.status_code < 500:
+                try:
+                    print(r.json()["error"])
+                except Exception:
+                    pass
+            return False
+
+        return r
+
+    def register_room(self,
+        name,
+        creator,
+        topic,
+        invitees,
+        preset,
+        server_location,
+        as_token,
+    ):
+        # register room
+        url = "%s/_matrix/client/r0/createRoom?user_id=%s" % (server_location,creator,)
+
+        # set up the whole room state with the createRoom request
+        initial_state = [
+            {
+                "type": "m.room.join_rules",
+                "state_key": "",
+                "content": {"join_rule": "public" if preset == "public_chat" else "invite"},
+            },
+            {
+                "type": "m.room.history_visibility",
+                "state_key": "",
+                "content": {"history_visibility": "shared"},
+            },
+        ]
+
+        room_name = "".join([name, self.config_yaml["room-suffix"]])
+        if room_name:
+            initial_state.append({"type": "m.room.name", "state_key": "", "content": {"name": room_name}})
+
+        if topic:
+            initial_state.append({"type": "m.room.topic", "state_key": "", "content": {"topic": topic}})
+
+        body = {
+            "preset": preset,
+            "visibility": "public",
+            "creation_content": {
+                "m.federate": self.config_yaml["federate-rooms"]
+            },
+            "initial_state": initial_state,
+            "invite": invitees,
+            "is_direct": True if preset == "trusted_private_chat" else False,
+        }
+
+        if name:
+            body["room_alias_name"] = name
+
+        #_print("Sending registration request...")
+        r = self.session.post(url, headers={'Authorization': 'Bearer ' + as_token}, json=body, verify=False)
+
+        if r.status_code != 200:
+            print("ERROR! Received %d %s" % (r.status_code, r.reason))
+            record_error(r)
+            if 400 <= r.status_code < 500:
+                try:
+                    print(r.json()["error"])
+                except Exception:
+                    pass
+            return False
+
+        return r
+
+    def autojoin_users(self,
+        invitees,
+        roomId,
+        config,
+    ):
+        for user in invitees:
+            #POST /_matrix/client/r0/rooms/{roomId}/join
+            url = "%s/_matrix/client/r0/rooms/%s/join?user_id=%s" % (config["homeserver"],roomId,user,)
+
+            #_print("Sending registration request...")
+            r = self.session.post(url, headers={'Authorization': 'Bearer ' + config["as_token"]}, verify=False)
+
+            if r.status_code != 200:
+                print("ERROR! Received %d %s" % (r.status_code, r.reason))
+                if 400 <= r.status_code < 500:
+                    try:
+                        print(r.json()["error"])
+                    except Exception:
+                        pass
+
+    def migrate_users(self, userFile, config, access_token):
+        userData = json_loads(userFile.read())
+        for user in userData:
+            if user["is_bot"] == True:
+                continue
+
+            # already migrated by a previous run
+            if user["id"] in self.userLUT:
+                continue
+
+            # ignore slackbot
+            if user["id"] == "USLACKBOT":
                 continue
 
-            # TODO force password change at next login
+            # the exports sharing the directory check and reserve their users
+            # one after the other, the registration runs outside the lock
+            with self.users.lock:
+                # the same person in another export, e.g. of an Enterprise Grid
+                matrixId = self.users.find(user)
+                if not matrixId:
+                    _servername = config["homeserver"].split('/')[2]
+                    _matrix_user = self.users.localpart(user)
+                    _matrix_id = '@' + _matrix_user + ':' + self.config_yaml["domain"]
+
+                    # check if display name is set
+                    if "real_name" in user["profile"]:
+                        _real_name = user["profile"]["real_name"]
+                    else:
+                        _real_name = ""
+
+                    # check if email is set
+                    if "email" in user["profile"]:
+                        _email = user["profile"]["email"]
+                    else:
+                        _email = ""
+
+                    # generate password
+                    _alphabet = string.ascii_letters + string.digits
+                    _password = ''.join(secrets.choice(_alphabet) for i in range(20)) # for a 20-character password
+
+                    userDetails = {
+                        "slack_id": user["id"],
+                        "slack_team_id": user["team_id"],
+                        "slack_name": user["name"],
+                        "slack_real_name": _real_name,
+                        "slack_email": _email,
+                        "matrix_id": _matrix_id,
+                        "matrix_user": _matrix_user,
+                        "matrix_password": _password,
+                    }
+                    # a failed registration keeps its reservation, the dead
+                    # letter registers the same Matrix id later
+                    self.users.reserve(userDetails)
+
+            if matrixId:
+                # its messages must not be sent before the user exists
+                self.users.wait(matrixId)
+                print("Slack user " + user["id"] + " is already registered as " + matrixId)
+                self.userLUT[user["id"]] = matrixId
+                self.nameLUT[matrixId] = user["profile"].get("real_name", "")
+                continue
+
+            print("Registering Slack user " + userDetails["slack_id"] + " -> " + userDetails["matrix_id"])
+            try:
+                if not config["dry-run"]:
+                    res = self.register_user(userDetails["matrix_user"], userDetails["matrix_password"], userDetails["slack_real_name"], config["homeserver"], access_token)
+                    if res == False:
+                        print("ERROR while registering user '" + userDetails["matrix_id"] + "'")
+                        dead_letter(config, "user", '', {"user": userDetails["slack_id"]}, userDetails)
+                        self.failed_users()[userDetails["slack_id"]] = userDetails["matrix_id"]
+                        continue
+
+                    # TODO force password change at next login
+            finally:
+                # other exports waiting for the user can go on
+                self.users.registered(userDetails["matrix_id"])
+
+            self.userLUT[userDetails["slack_id"]] = userDetails["matrix_id"]
+            self.nameLUT[userDetails["matrix_id"]] = userDetails["slack_real_name"]
+            self.userlist.append(userDetails)
+        return self.userlist
+
 
-        userLUT[userDetails["slack_id"]] = userDetails["matrix_id"]
-        nameLUT[userDetails["matrix_id"]] = userDetails["slack_real_name"]
-        userlist.append(userDetails)
-    return userlist
+    def provision_room(self, roomDetails, invitees, preset, config):
+        res = self.register_room(roomDetails.get("slack_name", ''), roomDetails["matrix_creator"], roomDetails.get("matrix_topic", ''), invitees, preset, config["homeserver"], config["as_token"])
 
+        if res == False:
+            dead_letter(config, "room", '', {"room": roomDetails["slack_id"]}, {"roomDetails": roomDetails, "invitees": invitees, "preset": preset})
+            return False
+
+        _content = json_loads(res.content)
+        roomDetails["matrix_id"] = _content["room_id"]
+
+        #autojoin all members
+        self.autojoin_users(invitees, roomDetails["matrix_id"], config)
+
+        return roomDetails
+
+    def provision_rooms(self, rooms, config, lut):
+        # rooms is a list of (roomDetails, invitees, preset), they are created
+        # concurrently and written to the LUTs as soon as they are done
+        roomlist = []
+
+        if config["dry-run"]:
+            for roomDetails, invitees, preset in rooms:
+                lut(roomDetails)
+                roomlist.append(roomDetails)
+            return roomlist
+
+        with ThreadPoolExecutor(max_workers=config["provision-workers"]) as pool:
+            futures = {}
+            for roomDetails, invitees, preset in rooms:
+                futures[pool.submit(self.provision_room, roomDetails, invitees, preset, config)] = (roomDetails, invitees, preset)
 
-def migrate_rooms(roomFile, config, admin_user):
-    roomlist = []
+            for future in as_completed(futures):
+                roomDetails, invitees, preset = futures[future]
+                _name = roomDetails.get("slack_name") or roomDetails["slack_id"]
+                try:
+                    res = future.result()
+                except Exception as e:
+                    print("ERROR while registering room '" + _name + "': " + str(e))
+                    dead_letter(config, "room", '', {"room": roomDetails["slack_id"]}, {"roomDetails": roomDetails, "invitees": invitees, "preset": preset}, str(e))
+                    continue
+
+                if res == False:
+                    print("ERROR while registering room '" + _name + "'")
+                    continue
+
+                print("Registered Slack channel " + _name + " -> " + roomDetails["matrix_id"])
+                lut(roomDetails)
+                roomlist.append(roomDetails)
+
+        return roomlist
+
+    def add_room_to_luts(self, roomDetails):
+        self.roomLUT[roomDetails["slack_id"]] = roomDetails["matrix_id"]
+        self.roomLUT2[roomDetails["slack_id"]] = roomDetails["slack_name"]
+        # stored right away, a crashed run must not create the room again
+        self.state.put("roomLUT", roomDetails["slack_id"], roomDetails["matrix_id"])
+        self.state.put("roomLUT2", roomDetails["slack_id"], roomDetails["slack_name"])
+
+    def add_dm_to_luts(self, roomDetails):
+        self.dmLUT[roomDetails["slack_id"]] = roomDetails["matrix_id"]
+        self.state.put("dmLUT", roomDetails["slack_id"], roomDetails["matrix_id"])
+
+    def migrate_rooms(self, roomFile, config, admin_user):
+        rooms = []
+
+        # channels
+        channelData = json_loads(roomFile.read())
+        for channel in channelData:
+            if config["skip-archived"]:
+                if channel["is_archived"] == True:
+                    continue
+
+            # already migrated by a previous run
+            if channel["id"] in self.roomLUT:
+                continue
 
-    # channels
-    channelData = json.load(roomFile)
-    for channel in channelData:
-        if config["skip-archived"]:
-            if channel["is_archived"] == True:
+            if not channel_selected(config, channel["name"]):
                 continue
 
-        if config_yaml["create-as-admin"]:
-            _mxCreator = "".join(["@", admin_user, ":", config_yaml["domain"]])
+            rooms.append(self.channel_room(channel, admin_user))
+
+        return self.provision_rooms(rooms, config, self.add_room_to_luts)
+
+    def channel_room(self, channel, admin_user):
+        '''(roomDetails, invitees, preset) of a Slack channel'''
+        if self.config_yaml["create-as-admin"]:
+            _mxCreator = "".join(["@", admin_user, ":", self.config_yaml["domain"]])
         else:
             # if user is not in LUT (maybe its a shared channel), default to admin_user
-            if channel["creator"] in userLUT:
-                _mxCreator = userLUT[channel["creator"]]
+            if channel["creator"] in self.userLUT:
+                _mxCreator = self.userLUT[channel["creator"]]
             else:
-                _mxCreator = "".join(["@", admin_user, ":", config_yaml["domain"]])
+                _mxCreator = "".join(["@", admin_user, ":", self.config_yaml["domain"]])
 
         _invitees = []
-        if config_yaml["invite-all"]:
-            for user in nameLUT.keys():
+        if self.config_yaml["invite-all"]:
+            for user in self.nameLUT.keys():
                 if user != _mxCreator:
                     _invitees.append(user)
         else:
             for user in channel["members"]:
                 if user != channel["creator"]:
-                    if user in userLUT: # ignore dropped users like bots
-                        _invitees.append(userLUT[user])
+                    if user in self.userLUT: # ignore dropped users like bots
+                        _invitees.append(self.userLUT[user])
 
         roomDetails = {
             "slack_id": channel["id"],
@@ -386,48 +707,43 @@ def migrate_rooms(roomFile, config, admin_user):
             "matrix_topic": channel["topic"]["value"],
         }
 
-        room_preset = "private_chat" if config_yaml["import-as-private"] else "public_chat"
+        room_preset = "private_chat" if self.config_yaml["import-as-private"] else "public_chat"
 
-        if not config["dry-run"]:
-            res = register_room(roomDetails["slack_name"], roomDetails["matrix_creator"], roomDetails["matrix_topic"], _invitees, room_preset, config["homeserver"], config["as_token"])
-
-            if res == False:
-                print("ERROR while registering room '" + roomDetails["slack_name"] + "'")
-                continue
-            else:
-                _content = json.loads(res.content)
-                roomDetails["matrix_id"] = _content["room_id"]
-            print("Registered Slack channel " + roomDetails["slack_name"] + " -> " + roomDetails["matrix_id"])
+        return roomDetails, _invitees, room_preset
 
-            #autojoin all members
-            autojoin_users(_invitees, roomDetails["matrix_id"], config)
+    def migrate_dms(self, roomFile, config):
+        rooms = []
 
-        roomLUT[roomDetails["slack_id"]] = roomDetails["matrix_id"]
-        roomLUT2[roomDetails["slack_id"]] = roomDetails["slack_name"]
-        roomlist.append(roomDetails)
+        if not config["dms"]:
+            return []
 
-    return roomlist
+        # channels
+        channelData = json_loads(roomFile.read())
+        for channel in channelData:
+            if config["skip-archived"]:
+                if channel["is_archived"] == True:
+                    continue
 
-def migrate_dms(roomFile, config):
-    roomlist = []
+            # skip dms with slackbot
+            if channel["user"] == "USLACKBOT":
+                continue
 
-    # channels
-    channelData = json.load(roomFile)
-    for channel in channelData:
-        if config["skip-archived"]:
-            if channel["is_archived"] == True:
+            # already migrated by a previous run
+            if channel["id"] in self.dmLUT:
                 continue
 
-        # skip dms with slackbot
-        if channel["user"] == "USLACKBOT":
-            continue
+            rooms.append(self.dm_room(channel))
 
-        _mxCreator = userLUT[channel["user"]]
+        return self.provision_rooms(rooms, config, self.add_dm_to_luts)
+
+    def dm_room(self, channel):
+        '''(roomDetails, invitees, preset) of a Slack DM'''
+        _mxCreator = self.userLUT[channel["user"]]
 
         _invitees = []
         for user in channel["members"]:
             if user != channel["user"]:
-                _invitees.append(userLUT[user])
+                _invitees.append(self.userLUT[user])
 
         roomDetails = {
             "slack_id": channel["id"],
@@ -438,382 +754,1097 @@ def migrate_dms(roomFile, config):
             "matrix_creator": _mxCreator,
         }
 
-        if not config["dry-run"]:
-            res = register_room('', roomDetails["matrix_creator"], '', _invitees, "trusted_private_chat", config["homeserver"], config["as_token"])
+        return roomDetails, _invitees, "trusted_private_chat"
 
-            if res == False:
-                print("ERROR while registering room '" + roomDetails["slack_name"] + "'")
-                continue
-            else:
-                _content = json.loads(res.content)
-                roomDetails["matrix_id"] = _content["room_id"]
-            print("Registered Slack DM channel " + roomDetails["slack_id"] + " -> " + roomDetails["matrix_id"])
+    def replace_mention(self, matchobj):
+        _slack_id = matchobj.group(0)[2:-1]
 
-            #autojoin all members
-            autojoin_users(_invitees, roomDetails["matrix_id"], config)
+        if not _slack_id in self.userLUT:
+            return ''
+        user_id = self.userLUT[_slack_id]
+        displayname = self.nameLUT[user_id]
 
-        dmLUT[roomDetails["slack_id"]] = roomDetails["matrix_id"]
-        roomlist.append(roomDetails)
+        return "<a href='https://matrix.to/#/" + user_id + "'>" + displayname + "</a>"
 
-    return roomlist
+    def skip_message(self, message):
+        '''True for messages that are not migrated, 'verify' doesn't expect them either'''
+        if message.get("subtype") in ignoredSubtypes:
+            return True
 
-def send_reaction(config, roomId, eventId, reactionKey, userId, txnId):
+        # ignore hidden messages and hidden files message
+        if message.get("hidden") == True or message.get("is_hidden_by_limit") == True:
+            return True
 
-    content = {
-        "m.relates_to": {
-            "event_id": eventId,
-            "key": reactionKey,
-            "rel_type": "m.annotation",
-        },
-    }
+        # ignore messages from bots, users that failed to be registered are no bots
+        return "user" in message and not message["user"] in self.userLUT and not message["user"] in self.failed_users()
 
-    res = send_event(config, content, roomId, userId, "m.reaction", txnId)
-
-    return res
-
-def replace_mention(matchobj):
-    _slack_id = matchobj.group(0)[2:-1]
-
-    if not _slack_id in userLUT:
-        return ''
-    user_id = userLUT[_slack_id]
-    displayname = nameLUT[user_id]
-
-    return "<a href='https://matrix.to/#/" + user_id + "'>" + displayname + "</a>"
-
-def getFallbackHtml(roomId, replyEvent):
-    originalBody = replyEvent["body"]
-    originalHtml = replyEvent["formatted_body"]
-    if not replyEvent["body"]:
-        originalHtml = originalBody
+    def failed_users(self):
+        '''Slack id -> Matrix id of the users that failed to be registered, read
+        from the dead letters once'''
+        if self.failedUsers is None:
+            self.failedUsers = {letter["content"]["slack_id"]: letter["content"]["matrix_id"] for letter in self.state.dead_letters() if letter["kind"] == "user"}
+        return self.failedUsers
 
-    return '<mx-reply><blockquote><a href="https://matrix.to/#/' + roomId + '/' + replyEvent["event_id"] + '">In reply to</a><a href="https://matrix.to/#/' + replyEvent["sender"] + '">' + replyEvent["sender"] + '</a><br />' + originalHtml + '</blockquote></mx-reply>'
-
-def getFallbackText(replyEvent):
-    originalBody = replyEvent["body"]
-    originalBody = originalBody.split("\n")
-    originalBody = "\n> ".join(originalBody)
-    return '> <' + replyEvent["sender"] + '> ' + originalBody
-
-def parse_and_send_message(config, message, matrix_room, txnId, is_later):
-    content = {}
-    is_thread = False
-    is_reply = False
-
-    if message["type"] == "message":
-        if "subtype" in message:
-            if (message["subtype"] == "bot_message" or
-                message["subtype"] == "bot_remove" or
-                message["subtype"] == "slackbot_response" or
-                message["subtype"] == "channel_name" or
-                message["subtype"] == "channel_join" or
-                message["subtype"] == "channel_purpose" or
-                message["subtype"] == "group_name" or
-                message["subtype"] == "group_join" or
-                message["subtype"] == "group_purpose"):
-                    return txnId
-
-            if message["subtype"] == "file_comment":
-                # TODO migrate file_comments
-                return txnId
-
-        # ignore hidden messages
-        if "hidden" in message:
-            if message["hidden"] == True:
-                return txnId
-        # ignore hidden files message
-        if "is_hidden_by_limit" in message:
-            if message["is_hidden_by_limit"] == True:
-                return txnId
-
-        if "user" in message: #TODO what messages have no user?
-            if not message["user"] in userLUT:
-                # ignore messages from bots
-                return txnId
-        else:
-            print("Message without user")
-            print(message)
-
-        # list of subtypes
-        '''
-        bot_message    A message was posted by an app or integration
-        me_message    A /me message was sent
-        message_changed    A message was changed
-        message_deleted    A message was deleted
-        channel_join    A member joined a channel
-        channel_leave    A member left a channel
-        channel_topic    A channel topic was updated
-        channel_purpose    A channel purpose was updated
-        channel_name    A channel was renamed
-        channel_archive    A channel was archived
-        channel_unarchive    A channel was unarchived
-        group_join    A member joined a group
-        group_leave    A member left a group
-        group_topic    A group topic was updated
-        group_purpose    A group purpose was updated
-        group_name    A group was renamed
-        group_archive    A group was archived
-        group_unarchive    A group was unarchived
-        file_share    A file was shared into a channel
-        file_reply    A reply was added to a file
-        file_mention    A file was mentioned in a channel
-        pinned_item    An item was pinned in a channel
-        unpinned_item    An item was unpinned from a channel
-        '''
-
-        body = message["text"]
-
-        # TODO do not migrate empty messages?
-        #if body == "":
-        #
-        #    return txnId
-
-        # replace mentions
-        body = body.replace("<!channel>", "@room");
-        body = body.replace("<!here>", "@room");
-        body = body.replace("<!everyone>", "@room");
-        body = re.sub('<@[A-Z0-9]+>', replace_mention, body)
-
-        if "files" in message:
-            if "subtype" in message:
-                print(message["subtype"])
-                if message["subtype"] == "file_comment" or message["subtype"] == "thread_broadcast":
-                    #TODO treat as reply
-                    print("")
+    def register_thread(self, message, events):
+        # the messages the replies of a thread parent reply to
+        previous_message = None
+        for reply in message["replies"]:
+            if "user" in message and "ts" in message:
+                first_message = event_key(message["user"], message["ts"])
+                current_message = event_key(reply["user"], reply["ts"])
+                if not previous_message:
+                    previous_message = first_message
+                events.replyLUT[current_message] = previous_message
+                if self.config_yaml["threads-reply-to-previous"]:
+                    previous_message = current_message
+
+    def parse_and_send_message(self, config, message, matrix_room, events, is_later):
+        content = {}
+        is_thread = False
+        is_reply = False
+
+        if message["type"] == "message":
+            if self.skip_message(message):
+                return
+
+            if message.get("user") in self.failed_users():
+                # the message waits for its user in the dead letters
+                print("ERROR user of message '" + message["user"] + " " + message.get("ts", "") + "' is not registered")
+                dead_letter(config, "message", matrix_room, {"user": message["user"], "ts": message.get("ts", "")}, {"message": message}, "user not registered")
+                if "replies" in message:
+                    self.register_thread(message, events)
+                return
+
+            if not "user" in message: #TODO what messages have no user?
+                print("Message without user")
+                print(message)
+
+            # derive the txnId from the Slack identity of the message so a resend is deduplicated
+            txnId = make_txn_id(matrix_room, message.get("user", ""), message.get("ts", ""))
+
+            # list of subtypes
+            '''
+            bot_message    A message was posted by an app or integration
+            me_message    A /me message was sent
+            message_changed    A message was changed
+            message_deleted    A message was deleted
+            channel_join    A member joined a channel
+            channel_leave    A member left a channel
+            channel_topic    A channel topic was updated
+            channel_purpose    A channel purpose was updated
+            channel_name    A channel was renamed
+            channel_archive    A channel was archived
+            channel_unarchive    A channel was unarchived
+            group_join    A member joined a group
+            group_leave    A member left a group
+            group_topic    A group topic was updated
+            group_purpose    A group purpose was updated
+            group_name    A group was renamed
+            group_archive    A group was archived
+            group_unarchive    A group was unarchived
+            file_share    A file was shared into a channel
+            file_reply    A reply was added to a file
+            file_mention    A file was mentioned in a channel
+            pinned_item    An item was pinned in a channel
+            unpinned_item    An item was unpinned from a channel
+            '''
+
+            body = message["text"]
+
+            # TODO do not migrate empty messages?
+            #if body == "":
+            #
+            #    return
+
+            # replace mentions
+            body = body.replace("<!channel>", "@room");
+            body = body.replace("<!here>", "@room");
+            body = body.replace("<!everyone>", "@room");
+            body = re.sub('<@[A-Z0-9]+>', self.replace_mention, body)
+
+            if "files" in message:
+                if "subtype" in message:
+                    print(message["subtype"])
+                    if message["subtype"] == "file_comment" or message["subtype"] == "thread_broadcast":
+                        #TODO treat as reply
+                        print("")
+                    else:
+                        process_files(message["files"], matrix_room, self.userLUT[message["user"]], body, txnId, config)
                 else:
-                    txnId = process_files(message["files"], matrix_room, userLUT[message["user"]], body, txnId, config)
+                    process_files(message["files"], matrix_room, self.userLUT[message["user"]], body, txnId, config)
+
+            if "attachments" in message:
+                if message["user"] in self.userLUT: # ignore attachments from bots
+                    process_attachments(message["attachments"], matrix_room, self.userLUT[message["user"]], body, txnId, config)
+                    for attachment in message["attachments"]:
+                        if "is_share" in attachment and attachment["is_share"]:
+                            if body:
+                                body += "\n"
+                            attachment_footer = "no footer"
+                            if "footer" in attachment:
+                                attachment_footer = attachment["footer"]
+                            attachment_text = "no text"
+                            if "text" in attachment:
+                                attachment_text = attachment["text"]
+                            body += "".join(["&gt; _Shared (", attachment_footer, "):_ ", attachment_text, "\n"])
+
+            if "replies" in message: # this is the parent of a thread
+                is_thread = True
+                self.register_thread(message, events)
+
+            # replys / threading
+            if "thread_ts" in message and "parent_user_id" in message and not "replies" in message: # this message is a reply to another message
+                is_reply = True
+                if not event_key(message["user"], message["ts"]) in events.replyLUT:
+                    # seems like we don't know the thread yet, save event for later
+                    if not is_later:
+                        events.postpone(message)
+                    return
+                slack_event_id = events.replyLUT[event_key(message["user"], message["ts"])]
+                matrix_event_id = events.eventLUT.get(slack_event_id)
+                if not matrix_event_id:
+                    # the previous message of the thread failed, fall back to the thread root
+                    matrix_event_id = events.eventLUT.get(event_key(message["parent_user_id"], message["thread_ts"]))
+
+            # TODO pinned / stared items?
+
+            with config["tracer"].span("transform", "message"):
+                # replace emojis
+                body = emoji.emojize(body, use_aliases=True)
+
+                # TODO some URLs with special characters (e.g. _ ) are parsed wrong
+                formatted_body = slackdown.render(body)
+
+            if not is_reply:
+                content = {
+                        "body": body,
+                        "msgtype": "m.text",
+                        "format": "org.matrix.custom.html",
+                        "formatted_body": formatted_body,
+                }
             else:
-                txnId = process_files(message["files"], matrix_room, userLUT[message["user"]], body, txnId, config)
-
-        if "attachments" in message:
-            if message["user"] in userLUT: # ignore attachments from bots
-                txnId = process_attachments(message["attachments"], matrix_room, userLUT[message["user"]], body, txnId, config)
-                for attachment in message["attachments"]:
-                    if "is_share" in attachment and attachment["is_share"]:
-                        if body:
-                            body += "\n"
-                        attachment_footer = "no footer"
-                        if "footer" in attachment:
-                            attachment_footer = attachment["footer"]
-                        attachment_text = "no text"
-                        if "text" in attachment:
-                            attachment_text = attachment["text"]
-                        body += "".join(["&gt; _Shared (", attachment_footer, "):_ ", attachment_text, "\n"])
-
-        if "replies" in message: # this is the parent of a thread
-            is_thread = True
-            previous_message = None
-            for reply in message["replies"]:
-                if "user" in message and "ts" in message:
-                    first_message = message["user"]+message["ts"]
-                    current_message = reply["user"]+reply["ts"]
-                    if not previous_message:
-                        previous_message = first_message
-                    replyLUT[current_message] = previous_message
-                    if config_yaml["threads-reply-to-previous"]:
-                        previous_message = current_message
-
-        # replys / threading
-        if "thread_ts" in message and "parent_user_id" in message and not "replies" in message: # this message is a reply to another message
-            is_reply = True
-            if not message["user"]+message["ts"] in replyLUT:
-                # seems like we don't know the thread yet, save event for later
-                if not is_later:
-                    later.append(message)
-                return txnId
-            slack_event_id = replyLUT[message["user"]+message["ts"]]
-            matrix_event_id = eventLUT[slack_event_id]
-
-        # TODO pinned / stared items?
-
-        # replace emojis
-        body = emojize(body, use_aliases=True)
-
-        # TODO some URLs with special characters (e.g. _ ) are parsed wrong
-        formatted_body = slackdown.render(body)
-
-        if not is_reply:
-            content = {
-                    "body": body,
+                fallback = events.threadLUT.get(event_key(message["parent_user_id"], message["thread_ts"]))
+                # the parent may have been evicted from the thread store, reply without fallback then
+                if fallback:
+                    body = fallback["text"] + "\n\n" + body
+                    formatted_body = fallback["html"] + formatted_body
+                content = {
+                    "m.relates_to": {
+                        "m.in_reply_to": {
+                            "event_id": matrix_event_id,
+                        },
+                    },
                     "msgtype": "m.text",
+                    "body": body,
                     "format": "org.matrix.custom.html",
                     "formatted_body": formatted_body,
-            }
-        else:
-            replyEvent = threadLUT[message["parent_user_id"]+message["thread_ts"]]
-            fallbackHtml = getFallbackHtml(matrix_room, replyEvent);
-            fallbackText = getFallbackText(replyEvent);
-            body = fallbackText + "\n\n" + body
-            formatted_body = fallbackHtml + formatted_body
-            content = {
-                "m.relates_to": {
-                    "m.in_reply_to": {
-                        "event_id": matrix_event_id,
-                    },
-                },
-                "msgtype": "m.text",
-                "body": body,
-                "format": "org.matrix.custom.html",
-                "formatted_body": formatted_body,
-            }
-
-        # send message
-        ts = message["ts"].replace(".", "")[:-3]
-        res = send_event(config, content, matrix_room, userLUT[message["user"]], "m.room.message", txnId, ts)
-        # save event id
-        if res == False:
-            print("ERROR while sending event '" + message["user"] + " " + message["ts"] + "'")
-        else:
-            _content = json.loads(res.content)
-            # use "user" combined with "ts" as id like Slack does as "client_msg_id" is not always set
-            if "user" in message and "ts" in message:
-                eventLUT[message["user"]+message["ts"]] = _content["event_id"]
-            txnId = txnId + 1
-            if is_thread:
-                threadLUT[message["user"]+message["ts"]] = {"body": body, "formatted_body": formatted_body, "sender": userLUT[message["user"]], "event_id": _content["event_id"]}
-
-            # handle reactions
-            if "reactions" in message:
-                roomId = matrix_room
-                eventId = eventLUT[message["user"]+message["ts"]]
-                for reaction in message["reactions"]:
+                }
+
+            # send message
+            ts = message["ts"].replace(".", "")[:-3]
+            ref = {"user": message["user"], "ts": message["ts"]}
+            if is_reply and not matrix_event_id:
+                # the thread root failed too, the reply waits for it in the dead letters
+                print("ERROR missing parent of reply '" + message["user"] + " " + message["ts"] + "'")
+                parent = {"user": message["parent_user_id"], "ts": message["thread_ts"]}
+                dead_letter(config, "event", matrix_room, ref, {"type": "m.room.message", "content": content, "user": self.userLUT[message["user"]], "txnId": txnId, "ts": ts, "parent": parent}, "parent event missing")
+                return
+            res = send_event(config, content, matrix_room, self.userLUT[message["user"]], "m.room.message", txnId, ts)
+            # save event id
+            if res == False:
+                print("ERROR while sending event '" + message["user"] + " " + message["ts"] + "'")
+                dead_letter_event(config, ref, content, matrix_room, self.userLUT[message["user"]], "m.room.message", txnId, ts)
+                # the reactions need the event id, keep them until the message is redriven
+                for reaction in message.get("reactions", []):
+                    reactionKey = emoji.emojize(":"+reaction["name"]+":", use_aliases=True)
                     for user in reaction["users"]:
-                        #print("Send reaction in room " + roomId)
-                        try:
-                            send_reaction(config, roomId, eventId, emojize(":"+reaction["name"]+":", use_aliases=True), userLUT[user], txnId)
-                            txnId = txnId + 1
-                        except KeyError:
-                            print("KeyError in reaction at " + message["ts"])
-
-    else:
-        print("Ignoring message type " + message["type"])
-    return txnId
+                        if user in self.userLUT:
+                            reactionContent = {"m.relates_to": {"event_id": None, "key": reactionKey, "rel_type": "m.annotation"}}
+                            dead_letter(config, "event", matrix_room, {"reaction": reaction["name"], "user": user}, {"type": "m.reaction", "content": reactionContent, "user": self.userLUT[user], "txnId": make_txn_id(txnId, "reaction", reaction["name"], user), "ts": 0, "parent": ref}, "parent event missing")
+            else:
+                _content = json_loads(res.content)
+                # use "user" combined with "ts" as id like Slack does as "client_msg_id" is not always set
+                if "user" in message and "ts" in message:
+                    events.eventLUT[event_key(message["user"], message["ts"])] = _content["event_id"]
+                if is_thread:
+                    # every reply of the thread quotes the parent, render the fallback only once
+                    parent = {"body": body, "formatted_body": formatted_body, "sender": self.userLUT[message["user"]], "event_id": _content["event_id"]}
+                    fallback = {"html": getFallbackHtml(matrix_room, parent, config["reply-fallback-length"]), "text": getFallbackText(parent, config["reply-fallback-length"])}
+                    events.threadLUT.put(event_key(message["user"], message["ts"]), fallback)
+
+                # handle reactions
+                if "reactions" in message:
+                    roomId = matrix_room
+                    eventId = _content["event_id"]
+                    for reaction in message["reactions"]:
+                        reactionKey = emoji.emojize(":"+reaction["name"]+":", use_aliases=True)
+                        for user in reaction["users"]:
+                            if user in self.failed_users():
+                                reactionContent = {"m.relates_to": {"event_id": eventId, "key": reactionKey, "rel_type": "m.annotation"}}
+                                dead_letter(config, "event", roomId, {"reaction": reaction["name"], "user": user}, {"type": "m.reaction", "content": reactionContent, "user": self.failed_users()[user], "txnId": make_txn_id(txnId, "reaction", reaction["name"], user), "ts": 0, "parent": None}, "user not registered")
+                                continue
+                            if not user in self.userLUT:
+                                print("KeyError in reaction at " + message["ts"])
+                                continue
+                            #print("Send reaction in room " + roomId)
+                            events.queue_reaction(send_reaction, config, roomId, eventId, reactionKey, self.userLUT[user], make_txn_id(txnId, "reaction", reaction["name"], user))
 
-def migrate_messages(fileList, matrix_room, config, tick):
-    global later
-    archive = zipfile.ZipFile(config["zipfile"], 'r')
-    txnId = 1
-    progress = 0
+        else:
+            print("Ignoring message type " + message["type"])
+
+    def migrate_messages(self, fileList, matrix_room, config, tick, watermark=None, present=None):
+        '''present: (sender, ts) -> event id of the messages already in the room
+        when listed day files are migrated again'''
+        # event maps only live as long as the room is migrated
+        events = RoomEvents(config)
+        highWater = watermark
+        messages = 0
+
+        # don't even read the day files older than the watermark
+        readList = [file for file in fileList if not skip_day_file(file, watermark)]
+        progress = tick * (len(fileList) - len(readList))
+
+        source = config["source"]
+        memory = config["memory"]
+        tracer = config["tracer"]
+        # compressed tars read all day files of the room from the stream at once
+        batches = [readList] if source.sequential else [[file] for file in readList]
 
-    for file in fileList:
         try:
-            fileData = archive.open(file)
-            messageData = json.load(fileData)
-        except:
-            print("Warning: Couldn't load data from file " + file + " in archive. Skipping this file.")
-
-        for message in messageData:
-            txnId = parse_and_send_message(config, message, matrix_room, txnId, False)
-
-        progress = progress + tick
-        update_progress(progress)
-
-    # process postponed messages
-    for message in later:
-        txnId = parse_and_send_message(config, message, matrix_room, txnId, True)
-
-    # clean up postponed messages
-    later = []
+            for batch in batches:
+                # wait for memory before the day files are read
+                with memory.reserve(day_file_memory([source.size(file) for file in batch])):
+                    for file, messageData in tracer.reads(source.iter_messages(batch)):
+                        for message in messageData:
+                            if "ts" in message:
+                                # already sent by a previous run
+                                if watermark and ts_key(message["ts"]) <= ts_key(watermark):
+                                    self.skip_migrated(config, message, matrix_room, events, watermark)
+                                    continue
+                                if present is not None and self.skip_present(config, file, message, events, present):
+                                    continue
+                                if not highWater or ts_key(message["ts"]) > ts_key(highWater):
+                                    highWater = message["ts"]
+                            with tracer.message(message):
+                                self.parse_and_send_message(config, message, matrix_room, events, False)
+                            messages = messages + 1
+
+                        progress = progress + tick
+                        # the progress bars of parallel rooms would overwrite each other
+                        if config["room-workers"] == 1:
+                            update_progress(progress)
+
+            # process postponed messages
+            dropped = None
+            lastReply = {}
+            for message in events.later:
+                # the parent may be in a day file that isn't read, but in the room
+                if (watermark or config["since"]) and not event_key(message["user"], message["ts"]) in events.replyLUT:
+                    self.find_thread(config, message, matrix_room, events, lastReply)
+                if not event_key(message["user"], message["ts"]) in events.replyLUT and before_since(config, message["thread_ts"]):
+                    # the parent is migrated later with 'until', redrive sends the reply then
+                    print("ERROR parent of reply '" + message["user"] + " " + message["ts"] + "' is older than 'since', it waits in the dead letters")
+                    dead_letter(config, "message", matrix_room, {"user": message["user"], "ts": message["ts"]}, {"message": message}, "parent event missing")
+                    continue
+                if not event_key(message["user"], message["ts"]) in events.replyLUT:
+                    print("ERROR parent of reply '" + message["user"] + " " + message["ts"] + "' not found, not sending it")
+                    messages = messages - 1
+                    if dropped is None or ts_key(message["ts"]) < ts_key(dropped):
+                        dropped = message["ts"]
+                    continue
+                with tracer.message(message):
+                    self.parse_and_send_message(config, message, matrix_room, events, True)
+        finally:
+            # wait for the reactions still in flight, frees the memory of the room
+            events.close()
+
+        if dropped is not None:
+            # keep the watermark below the dropped replies, the next run tries them again
+            before = str(ts_key(dropped) - 1)
+            highWater = before[:-6] + "." + before[-6:]
+        return highWater, messages
+
+    def migrated_events(self, matrix_room, events):
+        '''(sender, ts) -> event of the messages in the room, read once per room'''
+        if events.migrated is None:
+            messages = self.room_messages(matrix_room, self.access_token)
+            if messages is None:
+                print("ERROR could not read the messages of room: %s, threads of earlier runs are not continued" % (matrix_room,))
+            events.migrated = {(event["sender"], event["origin_server_ts"]): event for event in messages or []}
+        return events.migrated
+
+    def remember_event(self, config, matrix_room, events, user, ts, is_parent=False):
+        '''the event of a message an earlier run sent, False if it isn't in the room'''
+        event = self.migrated_events(matrix_room, events).get((self.userLUT.get(user), int(ts.replace(".", "")[:-3])))
+        if event is None:
+            return False
+        events.eventLUT[event_key(user, ts)] = event["event_id"]
+        if is_parent:
+            content = event["content"]
+            parent = {"body": content.get("body", ""), "formatted_body": content.get("formatted_body", html.escape(content.get("body", ""))), "sender": event["sender"], "event_id": event["event_id"]}
+            fallback = {"html": getFallbackHtml(matrix_room, parent, config["reply-fallback-length"]), "text": getFallbackText(parent, config["reply-fallback-length"])}
+            events.threadLUT.put(event_key(user, ts), fallback)
+        return True
+
+    def skip_migrated(self, config, message, matrix_room, events, watermark):
+        '''a thread parent sent by an earlier run whose thread goes on in this one'''
+        if not "replies" in message or not "user" in message:
+            return
+        if all(ts_key(reply["ts"]) <= ts_key(watermark) for reply in message["replies"]):
+            return
+        self.register_thread(message, events)
+        self.remember_event(config, matrix_room, events, message["user"], message["ts"], True)
+        # the new replies may reply to the previous one
+        for reply in message["replies"]:
+            if ts_key(reply["ts"]) <= ts_key(watermark):
+                self.remember_event(config, matrix_room, events, reply["user"], reply["ts"])
+
+    def find_thread(self, config, message, matrix_room, events, lastReply):
+        '''a reply whose parent is in a day file older than the watermark, it
+        replies to the parent in the room or the previous reply of this run'''
+        parentKey = event_key(message["parent_user_id"], message["thread_ts"])
+        if not parentKey in events.eventLUT and not self.remember_event(config, matrix_room, events, message["parent_user_id"], message["thread_ts"], True):
+            return
+        events.replyLUT[event_key(message["user"], message["ts"])] = lastReply.get(parentKey, parentKey)
+        if self.config_yaml["threads-reply-to-previous"]:
+            lastReply[parentKey] = event_key(message["user"], message["ts"])
+
+    def skip_present(self, config, file, message, events, present):
+        '''whether a message of a listed day file is left out, the homeserver
+        only deduplicates the txnIds of the last minutes'''
+        ts = int(message["ts"].replace(".", "")[:-3])
+        wanted = config["day-files"].get(file)
+        eventId = present.get((self.userLUT.get(message.get("user")), ts))
+        if eventId is None and (wanted is None or ts in wanted):
+            return False
+
+        # replies and reactions of the messages that are sent need the event
+        if eventId is not None and "user" in message:
+            events.eventLUT[event_key(message["user"], message["ts"])] = eventId
+        if "replies" in message:
+            self.register_thread(message, events)
+        return True
+
+    def kick_imported_users(self, server_location, admin_user, access_token, tick):
+        headers = {'Authorization': ' '.join(['Bearer', access_token])}
+        progress = 0
 
-def kick_imported_users(server_location, admin_user, access_token, tick):
-    headers = {'Authorization': ' '.join(['Bearer', access_token])}
-    progress = 0
+        for room in self.roomLUT.values():
+            url = "%s/_matrix/client/r0/rooms/%s/kick" % (server_location, room)
 
-    for room in roomLUT.values():
-        url = "%s/_matrix/client/r0/rooms/%s/kick" % (server_location, room)
+            for name in self.nameLUT.keys():
+                data = {"user_id": name}
 
-        for name in nameLUT.keys():
-            data = {"user_id": name}
+                r = self.session.post(url, json=data, headers=headers, verify=False)
 
-            r = requests.post(url, json=data, headers=headers, verify=False)
+                if r.status_code != 200 and r.status_code != 201:
+                    print("ERROR! Received %d %s" % (r.status_code, r.reason))
+                    if 400 <= r.status_code < 500:
+                        try:
+                            print(r.json()["error"])
+                        except Exception:
+                            pass
+
+            progress = progress + tick
+            update_progress(progress)
+
+    def save_luts(self):
+        self.state.save("userLUT", self.userLUT)
+        self.state.save("nameLUT", self.nameLUT)
+        self.state.save("roomLUT", self.roomLUT)
+        self.state.save("roomLUT2", self.roomLUT2)
+        self.state.save("dmLUT", self.dmLUT)
+        # only the users registered by this run, earlier ones are already stored
+        self.state.add_users(self.userlist)
+
+    def migrate_room_messages(self, job, config):
+        fileList = job["files"]
+        if fileList:
+            name = job["slack_room"] if job["is_dm"] else self.roomLUT2[job["slack_room"]]
+            print("Migrating messages for room: %s (%d day files, %d bytes, predicted %.1fs)" % (name, len(fileList), job["bytes"], job["predicted"]))
+            start = time.time()
 
-            if r.status_code != 200 and r.status_code != 201:
+            tick = 1/len(fileList)
+            watermark = self.watermarkLUT.get(job["slack_room"]) if config["delta"] and config["day-files"] is None else None
+            # listed day files are migrated again, without the messages already in the room
+            present = None
+            if config["day-files"] is not None:
+                present = self.room_events(job["matrix_room"], self.access_token)
+                if present is None:
+                    print("ERROR could not read the messages of room: %s, skipping it" % (name,))
+                    return
+            with config["tracer"].span("room " + name, "room", always=True, files=len(fileList), bytes=job["bytes"]) as span:
+                highWater, messages = self.migrate_messages(fileList, job["matrix_room"], config, tick, watermark, present)
+                span["messages"] = messages
+
+            # refine the prediction for the following rooms and runs
+            duration = time.time() - start
+            record(self.scheduleStats, job, duration, messages)
+            print("Migrated %d messages for room: %s in %.1fs (predicted %.1fs)" % (messages, name, duration, job["predicted"]))
+
+            # a run restricted to older days ('until') must not move the watermark back
+            if highWater and (not job["slack_room"] in self.watermarkLUT or ts_key(highWater) > ts_key(self.watermarkLUT[job["slack_room"]])):
+                self.watermarkLUT[job["slack_room"]] = highWater
+                # remember the progress so the next (delta) run can resume from here
+                self.state.put("watermarkLUT", job["slack_room"], highWater)
+            self.state.save("scheduleStats", snapshot(self.scheduleStats))
+
+    def migration_jobs(self, config):
+        jobs = []
+        for slack_room, matrix_room in self.roomLUT.items():
+            jobs.append(room_job(config, slack_room, matrix_room, self.roomLUT2[slack_room], False))
+        for slack_room, matrix_room in self.dmLUT.items():
+            jobs.append(room_job(config, slack_room, matrix_room, slack_room, True))
+        jobs = [job for job in jobs if job_selected(config, job)]
+
+        jobs = order_rooms(jobs, self.scheduleStats)
+        if config["source"].sequential:
+            # compressed tars can only be read front to back, keep the archive order
+            jobs.sort(key=lambda job: config["source"].order.get(job["files"][0], 0) if job["files"] else 0)
+        return jobs
+
+    def plan_jobs(self, config, jsonFiles):
+        # rooms of the export, whether they are already migrated or not
+        jobs = []
+        for channelType in ["channels.json", "groups.json", "dms.json"]:
+            if not channelType in jsonFiles:
+                continue
+            for channel in json_loads(jsonFiles[channelType].read()):
+                if config["skip-archived"] and channel.get("is_archived"):
+                    continue
+                if channelType == "dms.json":
+                    if channel["user"] == "USLACKBOT":
+                        continue
+                    job = room_job(config, channel["id"], self.dmLUT.get(channel["id"]), channel["id"], True)
+                else:
+                    job = room_job(config, channel["id"], self.roomLUT.get(channel["id"]), channel["name"], False)
+                job["channel"] = channel
+                jobs.append(job)
+        jobs = [job for job in jobs if job_selected(config, job)]
+
+        return order_rooms(jobs, self.scheduleStats)
+
+    def plan(self):
+        config = self.config
+        jsonFiles = loadZip(config)
+        jobs = self.plan_jobs(config, jsonFiles)
+
+        # simulate the workers to predict the duration of the whole run
+        workers = [0.0] * config["room-workers"]
+        for job in jobs:
+            name = job["folder"] if job["is_dm"] else "#" + job["folder"]
+            status = "migrated" if job["matrix_room"] else "new"
+            print("%-40s %-8s %6d day files %12d bytes %10.1fs" % (name, status, len(job["files"]), job["bytes"], job["predicted"]))
+            workers[workers.index(min(workers))] += job["predicted"]
+
+        print("%d rooms, %d bytes, predicted %.1fs with %d room workers" % (len(jobs), sum(job["bytes"] for job in jobs), max(workers), len(workers)))
+
+    def kick(self):
+        config = self.config
+
+        admin_user, access_token = self.login(config["homeserver"])
+
+        if self.roomLUT:
+            print("Kicking imported users from rooms. This may take a while...")
+            tick = 1/len(self.roomLUT)
+            self.kick_imported_users(config["homeserver"], admin_user, access_token, tick)
+
+    def connect(self, config):
+        jsonFiles = loadZip(config)
+
+        # login with admin user to gain access token
+        login = self.login(config["homeserver"])
+        if login == False:
+            raise MigrationError("ERROR! Admin user could not be logged in.")
+        admin_user, access_token = login
+
+        maxUploadSize = self.getMaxUploadSize(config, access_token)
+        config["maxUploadSize"] = maxUploadSize
+        self.access_token = access_token
+
+        return jsonFiles, admin_user, access_token
+
+    def provision_all(self, config, jsonFiles, admin_user, access_token):
+        if config["delta"]:
+            print("Delta mode: only migrating new users, rooms and messages")
+
+        # create users in matrix and match them to slack users
+        if "users.json" in jsonFiles and (not self.userLUT or config["delta"]):
+            self.migrate_users(jsonFiles["users.json"], config, access_token)
+
+        # create rooms and match to channels, the rooms of earlier runs (e.g.
+        # of another selection of channels) are left out
+        # Slack channels
+        if "channels.json" in jsonFiles:
+            roomlist_channels = self.migrate_rooms(jsonFiles["channels.json"], config, admin_user)
+
+        # Slack groups
+        if "groups.json" in jsonFiles:
+            roomlist_groups = self.migrate_rooms(jsonFiles["groups.json"], config, admin_user)
+
+        # create DMs
+        if "dms.json" in jsonFiles:
+            roomlist_dms = self.migrate_dms(jsonFiles["dms.json"], config)
+
+        # write LUTs to file to be able to load from later if something goes wrong
+        if not self.read_luts or config["delta"]:
+            self.save_luts()
+
+    def migrate_all_messages(self, config, jobs):
+        if config["room-workers"] > 1:
+            with ThreadPoolExecutor(max_workers=config["room-workers"]) as pool:
+                futures = {}
+                for job in jobs:
+                    futures[pool.submit(self.migrate_room_messages, job, config)] = job
+
+                for future in as_completed(futures):
+                    if future.exception():
+                        print("ERROR while migrating messages for room '" + futures[future]["folder"] + "': " + str(future.exception()))
+        else:
+            for job in jobs:
+                self.migrate_room_messages(job, config)
+
+    def provision(self):
+        config = self.config
+        jsonFiles, admin_user, access_token = self.connect(config)
+        self.provision_all(config, jsonFiles, admin_user, access_token)
+
+    def migrate(self, shard=None):
+        '''migrate users, rooms and messages, or only the messages of shard
+        (index, count) of the rooms'''
+        config = self.config
+        jsonFiles, admin_user, access_token = self.connect(config)
+
+        # shards only migrate messages, the coordinator provisioned users and rooms
+        if shard:
+            if not self.roomLUT and not self.dmLUT:
+                raise MigrationError("No rooms in the state file, run 'provision' before migrating shards")
+        else:
+            self.provision_all(config, jsonFiles, admin_user, access_token)
+
+        # send events to rooms and dms
+        print("Migrating messages to rooms and DMs. This may take a while...")
+        jobs = self.migration_jobs(config)
+        if shard:
+            index, count = shard
+            jobs = shard_jobs(jobs, index, count)
+            print("Shard %d/%d: migrating %d rooms" % (index, count, len(jobs)))
+
+        self.migrate_all_messages(config, jobs)
+        print(config["memory"].report())
+        config["tracer"].save(".shard%d" % shard[0] if shard else "")
+
+        # kick imported users from non-dm rooms, shards do that after 'merge'
+        if self.config_yaml["kick-imported-users"] and not shard:
+            print("Kicking imported users from rooms. This may take a while...")
+            tick = 1/len(self.roomLUT)
+            self.kick_imported_users(config["homeserver"], admin_user, access_token, tick)
+
+    def merge(self, shardFiles):
+        # the shards started with a copy of this state, add what they did since
+        baseStats = dict(self.scheduleStats)
+        baseLetters = set(letter["id"] for letter in self.state.dead_letters())
+        for filename in shardFiles:
+            print("Merging " + filename)
+            shard = State(filename)
+            for slack_room, highWater in shard.load("watermarkLUT").items():
+                if not slack_room in self.watermarkLUT or ts_key(highWater) > ts_key(self.watermarkLUT[slack_room]):
+                    self.watermarkLUT[slack_room] = highWater
+            shardStats = shard.load("scheduleStats")
+            for key in ["bytes", "seconds", "messages", "message_seconds"]:
+                self.scheduleStats[key] = self.scheduleStats.get(key, 0) + shardStats.get(key, 0) - baseStats.get(key, 0)
+            self.scheduleStats.setdefault("rooms", {}).update(shardStats.get("rooms", {}))
+
+            # the shard's copies of the coordinator's dead letters are still there
+            for letter in shard.dead_letters():
+                if letter["id"] in baseLetters:
+                    continue
+                self.state.add_dead_letter(letter["kind"], letter["room"], letter["ref"], letter["content"], letter["error"])
+
+        self.state.save("watermarkLUT", self.watermarkLUT)
+        self.state.save("scheduleStats", self.scheduleStats)
+
+    def room_messages(self, roomId, access_token):
+        '''the message events of the room, None if they can't be read'''
+        # the admin API reads rooms the admin isn't a member of
+        url = "%s/_synapse/admin/v1/rooms/%s/messages" % (self.config["homeserver"], roomId)
+        headers = {'Authorization': 'Bearer ' + access_token}
+        params = {"dir": "f", "limit": 1000, "filter": json.dumps({"types": ["m.room.message"]})}
+
+        messages = []
+        while True:
+            r = self.session.get(url, headers=headers, params=params, verify=False)
+            if r.status_code != 200:
                 print("ERROR! Received %d %s" % (r.status_code, r.reason))
-                if 400 <= r.status_code < 500:
-                    try:
-                        print(r.json()["error"])
-                    except Exception:
-                        pass
+                return None
+
+            page = json_loads(r.content)
+            messages.extend(event for event in page["chunk"] if event["type"] == "m.room.message")
+            if not page["chunk"] or not page.get("end"):
+                return messages
+            params["from"] = page["end"]
+
+    def room_timestamps(self, roomId, access_token):
+        messages = self.room_messages(roomId, access_token)
+        return None if messages is None else [event["origin_server_ts"] for event in messages]
+
+    def room_events(self, roomId, access_token):
+        '''(sender, ts) -> event id of the messages in the room, files are sent
+        before their message so the message itself wins'''
+        messages = self.room_messages(roomId, access_token)
+        return None if messages is None else {(event["sender"], event["origin_server_ts"]): event["event_id"] for event in messages}
+
+    def export_timestamps(self, job):
+        '''day file -> ts (in ms, as sent) of the messages migrated from it'''
+        index = {}
+        for file, messageData in self.config["source"].iter_messages(job["files"]):
+            index[file] = [int(message["ts"].replace(".", "")[:-3]) for message in messageData if message.get("type") == "message" and "ts" in message and "user" in message and not self.skip_message(message)]
+        return index
+
+    def verify(self, workers=8, output="gaps.txt"):
+        '''compare the messages of the rooms with the export, the day files with
+        missing messages and their ts are written to output, see --day-files'''
+        config = self.config
+        jsonFiles, admin_user, access_token = self.connect(config)
+        jobs = self.migration_jobs(config)
+
+        def day(ms):
+            return time.strftime("%Y-%m-%d %H:%M", time.gmtime(ms / 1000)) if ms else "-"
+
+        gaps = []
+        totalMissing = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # the rooms are read from the homeserver while the export is indexed
+            futures = {job["slack_room"]: pool.submit(self.room_timestamps, job["matrix_room"], access_token) for job in jobs}
+
+            for job in jobs:
+                name = job["folder"] if job["is_dm"] else "#" + job["folder"]
+                index = self.export_timestamps(job)
+                found = futures[job["slack_room"]].result()
+                if found is None:
+                    print("%-40s could not be read from the homeserver" % name)
+                    continue
+
+                # a message counts as migrated if an event with its ts exists, files
+                # of a message are sent with the same ts
+                present = set(found)
+                expected = sorted(ts for timestamps in index.values() for ts in timestamps)
+                missing = [ts for ts in expected if not ts in present]
+                print("%-40s %6d expected %6d events %6d missing  first %s / %s  last %s / %s" % (name, len(expected), len(found), len(missing), day(expected[0] if expected else 0), day(min(found) if found else 0), day(expected[-1] if expected else 0), day(max(found) if found else 0)))
+
+                if missing:
+                    totalMissing += len(missing)
+                    gaps.append("# %s: %d of %d messages missing" % (name, len(missing), len(expected)))
+                    for file in job["files"]:
+                        # only the missing messages are sent again
+                        fileMissing = [str(ts) for ts in index.get(file, []) if not ts in present]
+                        if fileMissing:
+                            gaps.append(file + " " + " ".join(fileMissing))
+
+        with open(output, "w") as f:
+            f.write("\n".join(gaps + [""]))
+        if totalMissing:
+            print("%d messages missing, they are listed in %s" % (totalMissing, output))
+        else:
+            print("No messages missing")
+
+    def canary_rooms(self, sample, count, admin_user, runId):
+        '''count throwaway copies of the sampled rooms, (job, roomDetails, invitees, preset)'''
+        rooms = []
+        for i in range(count):
+            job = sample[i % len(sample)]
+            if job["is_dm"]:
+                roomDetails, invitees, preset = self.dm_room(job["channel"])
+            else:
+                roomDetails, invitees, preset = self.channel_room(job["channel"], admin_user)
+                # the alias must not clash with the real room
+                roomDetails["slack_name"] = "canary-%d-%d-%s" % (runId, len(rooms), job["channel"]["name"])
+            rooms.append((job, roomDetails, invitees, preset))
+        return rooms
+
+    def delete_room(self, roomId, access_token):
+        url = "%s/_synapse/admin/v1/rooms/%s" % (self.config["homeserver"], roomId)
+        r = self.session.delete(url, headers={'Authorization': 'Bearer ' + access_token}, json={"purge": True}, verify=False)
+        if r.status_code != 200:
+            print("ERROR! Received %d %s" % (r.status_code, r.reason))
 
-        progress = progress + tick
-        update_progress(progress)
+    def canary(self, perBucket=1, levels=[1, 2, 4, 8], keep=False):
+        '''migrate a sample of the rooms into throwaway rooms with more and more
+        room workers and recommend the number of room workers'''
+        jsonFiles, admin_user, access_token = self.connect(self.config)
+
+        # the senders of the messages, they are kept for the real run
+        if "users.json" in jsonFiles and not self.userLUT:
+            self.migrate_users(jsonFiles["users.json"], self.config, access_token)
+            self.save_luts()
+
+        jobs = self.plan_jobs(self.config, jsonFiles)
+        sample = sample_rooms(jobs, perBucket)
+        if not sample:
+            print("No rooms with messages in the export")
+            return
+        for job in sample:
+            print("Sampled %-6s room %s (%d bytes)" % (job["bucket"], job["folder"], job["bytes"]))
+
+        runId = int(time.time())
+        results = []
+        canaryRooms = []
+        for level in levels:
+            print("Canary with %d room workers" % level)
+            stats = RequestStats()
+            session = self.new_session(level)
+            session.hooks["response"].append(stats.response)
+            # no dead letters, the rooms are thrown away; every copy downloads
+            # and uploads its files itself like the real run would
+            config = dict(self.config, session=session, state=None, cache=None)
+            config["room-workers"] = level
+            probe = copy.copy(self)
+            probe.session = session
+            probe.config = config
+
+            # every worker migrates its own copy of a sampled room
+            rooms = self.canary_rooms(sample, max(level, len(sample)), admin_user, runId * 100 + level)
+            probe.provision_rooms([(roomDetails, invitees, preset) for job, roomDetails, invitees, preset in rooms], config, lambda roomDetails: None)
+            rooms = [(job, roomDetails) for job, roomDetails, invitees, preset in rooms if roomDetails["matrix_id"]]
+            canaryRooms.extend(roomDetails["matrix_id"] for job, roomDetails in rooms)
+            if not rooms:
+                print("No canary room could be created, no measurement")
+                continue
 
-def main():
-    logging.captureWarnings(True)
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=level) as pool:
+                futures = [pool.submit(probe.migrate_messages, job["files"], roomDetails["matrix_id"], dict(config, uploads=Uploads()), 1/len(job["files"])) for job, roomDetails in rooms]
+                for future in as_completed(futures):
+                    if future.exception():
+                        print("ERROR in canary room: " + str(future.exception()))
+            seconds = time.time() - start
+
+            result = {"level": level, "seconds": seconds, "rate": sum(job["bytes"] for job, roomDetails in rooms) / seconds, "throttled": stats.throttled_rate()}
+            results.append(result)
+            print("%d room workers: %.1f events/s, %.0f bytes/s, %.1f%% rate limited" % (level, stats.count("send") / seconds, result["rate"], result["throttled"] * 100))
+            stats.report()
+
+        if not keep:
+            print("Deleting %d canary rooms" % len(canaryRooms))
+            for roomId in canaryRooms:
+                self.delete_room(roomId, access_token)
+
+        best = recommend(results)
+        if best is None:
+            print("No measurement, no recommendation for room-workers")
+            return
+        total = sum(job["bytes"] for job in jobs)
+        print("Recommended: room-workers: %d, about %.0fs for the %d bytes of the export" % (best["level"], total / best["rate"], total))
+
+    def redrive_letter(self, letter, config, access_token):
+        '''replay a dead letter, the error if it failed again'''
+        content = letter["content"]
+
+        if letter["kind"] == "user":
+            res = self.register_user(content["matrix_user"], content["matrix_password"], content["slack_real_name"], config["homeserver"], access_token)
+            if res == False:
+                return last_error()
+            self.users.add(content)
+            self.failed_users().pop(content["slack_id"], None)
+            self.userLUT[content["slack_id"]] = content["matrix_id"]
+            self.nameLUT[content["matrix_id"]] = content["slack_real_name"]
+            self.userlist.append(content)
+            return None
+
+        # rooms and files would put themselves back into the dead letters, the
+        # letter is kept until it succeeds instead
+        if letter["kind"] == "room":
+            with capture_dead_letters() as failed:
+                roomDetails = self.provision_room(content["roomDetails"], content["invitees"], content["preset"], config)
+            if not roomDetails:
+                return failed[0] if failed else "room not created"
+            if content["preset"] == "trusted_private_chat":
+                self.add_dm_to_luts(roomDetails)
+            else:
+                self.add_room_to_luts(roomDetails)
+            return None
+
+        if letter["kind"] == "file":
+            with capture_dead_letters() as failed:
+                process_file(content["file"], letter["room"], content["user"], content["body"], content["txnId"], config)
+            return failed[0] if failed else None
+
+        if letter["kind"] == "message":
+            return self.redrive_message(content["message"], letter["room"], config)
+
+        message = content["content"]
+        if content["parent"]:
+            parentId = self.state.event_id(letter["room"], content["parent"]["user"], content["parent"]["ts"])
+            if not parentId:
+                return "parent event missing"
+            if content["type"] == "m.reaction":
+                message["m.relates_to"]["event_id"] = parentId
+            else:
+                message["m.relates_to"]["m.in_reply_to"]["event_id"] = parentId
 
-    config = test_config(yaml)
-
-    jsonFiles = loadZip(config)
-
-    # login with admin user to gain access token
-    admin_user, access_token = login(config["homeserver"])
-
-    maxUploadSize = getMaxUploadSize(config, access_token)
-    config["maxUploadSize"] = maxUploadSize
-
-    if access_token == False:
-        print("ERROR! Admin user could not be logged in.")
-        exit(1)
-
-    # create users in matrix and match them to slack users
-    if "users.json" in jsonFiles and not userLUT:
-        userlist = migrate_users(jsonFiles["users.json"], config, access_token)
-
-    # create rooms and match to channels
-    # Slack channels
-    if "channels.json" in jsonFiles and not roomLUT:
-        roomlist_channels = migrate_rooms(jsonFiles["channels.json"], config, admin_user)
-
-    # Slack groups
-    if "groups.json" in jsonFiles and not roomLUT:
-        roomlist_groups = migrate_rooms(jsonFiles["groups.json"], config, admin_user)
-
-    # create DMs
-    if "dms.json" in jsonFiles and not dmLUT:
-        roomlist_dms = migrate_dms(jsonFiles["dms.json"], config, admin_user)
-
-    # write LUTs to file to be able to load from later if something goes wrong
-    if not read_luts:
-        data = dict(
-            userLUT = userLUT,
-            nameLUT = nameLUT,
-            roomLUT = roomLUT,
-            roomLUT2 = roomLUT2,
-            dmLUT = dmLUT,
-            users = userlist,
-        )
-        with open('luts.yaml', 'w') as outfile:
-            yaml.dump(data, outfile, default_flow_style=False)
-
-    # send events to rooms
-    print("Migrating messages to rooms. This may take a while...")
-    for slack_room, matrix_room in roomLUT.items():
-        print("Migrating messages for room: " + roomLUT2[slack_room])
-        fileList = sorted(loadZipFolder(config, roomLUT2[slack_room]))
-        if fileList:
-            tick = 1/len(fileList)
-            migrate_messages(fileList, matrix_room, config, tick)
+        res = send_event(config, message, letter["room"], content["user"], content["type"], content["txnId"], content["ts"])
+        if res == False:
+            return last_error()
+
+        # replies and reactions still waiting for this message look it up here
+        ref = letter["ref"]
+        if "user" in ref and "ts" in ref:
+            self.state.put_event(letter["room"], ref["user"], ref["ts"], json_loads(res.content)["event_id"])
+        return None
+
+    def redrive_message(self, message, room, config):
+        '''a Slack message of a user that failed to be registered'''
+        if not message["user"] in self.userLUT:
+            return "user not registered"
+        key = event_key(message["user"], message["ts"])
+        events = RoomEvents(config)
+        try:
+            with capture_dead_letters() as failed:
+                if "thread_ts" in message and "parent_user_id" in message and not "replies" in message:
+                    # the parent is in the room by now
+                    self.find_thread(config, message, room, events, {})
+                    if not key in events.replyLUT:
+                        return "parent event missing"
+                self.parse_and_send_message(config, message, room, events, True)
+        finally:
+            events.close()
+        if failed:
+            return failed[0]
+
+        # replies and reactions still waiting for this message look it up here
+        if key in events.eventLUT:
+            self.state.put_event(room, message["user"], message["ts"], events.eventLUT[key])
+        return None
+
+    def redrive_stage(self, letters, config, access_token, workers):
+        done = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for letter in letters:
+                futures[pool.submit(self.redrive_letter, letter, config, access_token)] = letter
+
+            for future in as_completed(futures):
+                letter = futures[future]
+                try:
+                    error = future.result()
+                except Exception as e:
+                    error = str(e)
+                # a letter is only removed once it went through, a crash keeps it
+                if error is not None:
+                    print("ERROR while redriving " + letter["kind"] + " " + json.dumps(letter["ref"]))
+                    self.state.set_dead_letter_error(letter["id"], error)
+                else:
+                    self.state.remove_dead_letter(letter["id"])
+                    done += 1
+        return done
+
+    def redrive(self, workers=8):
+        config = self.config
+        letters = self.state.dead_letters()
+        if not letters:
+            print("No dead letters")
+            return
+        if config["dry-run"]:
+            for letter in letters:
+                print("%-6s %-12s %s  %s" % (letter["kind"], letter["room"], json.dumps(letter["ref"]), letter["error"]))
+            return
+
+        jsonFiles, admin_user, access_token = self.connect(config)
+
+        # users and rooms first, events relating to another event (replies and
+        # reactions) after the event they relate to
+        stages = [
+            [letter for letter in letters if letter["kind"] == "user"],
+            [letter for letter in letters if letter["kind"] == "room"],
+            [letter for letter in letters if letter["kind"] in ["event", "file"] and not letter["content"].get("parent") or letter["kind"] == "message" and not "parent_user_id" in letter["content"]["message"]],
+            [letter for letter in letters if letter["kind"] == "event" and letter["content"].get("parent") or letter["kind"] == "message" and "parent_user_id" in letter["content"]["message"]],
+        ]
+        done = 0
+        for stage in stages:
+            if stage:
+                done += self.redrive_stage(stage, config, access_token, workers)
+                self.save_luts()
+
+        print("Replayed %d of %d dead letters, %d left" % (done, len(letters), len(self.state.dead_letters())))
+
+def parse_shard(value):
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard must be between 1/%d and %d/%d" % (count, count, count))
+    return index, count
+
+def parse_levels(value):
+    try:
+        levels = [int(part) for part in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected numbers of workers, e.g. 1,2,4,8")
+    if not levels or min(levels) < 1:
+        raise argparse.ArgumentTypeError("at least one worker is needed")
+    return levels
+
+def shard_state(filename, shard):
+    # every shard works with its own copy of the coordinator's state
+    base, ext = os.path.splitext(filename)
+    shardFile = "%s.shard-%d-of-%d%s" % (base, shard[0], shard[1], ext)
+    if not os.path.isfile(shardFile):
+        if not os.path.isfile(filename):
+            raise MigrationError("State file " + filename + " does not exist, run 'provision' first")
+        State(filename).copy_to(shardFile)
+    return shardFile
+
+def export_configs(config_yaml):
+    '''(config, state file) of every export in 'exports', the keys of an entry
+    override the config for its export'''
+    exports = []
+    for export in config_yaml["exports"]:
+        config = dict(config_yaml)
+        del config["exports"]
+        config.update(export)
+        name = export.get("name") or os.path.basename(os.path.normpath(export["zipfile"])).split(".")[0]
+        # the exports must not overwrite each other's trace
+        if config.get("trace-file") and not "trace-file" in export:
+            config["trace-file"] = "%s.%s" % (config["trace-file"], name)
+        exports.append((config, export.get("state", "luts.%s.db" % name)))
+    return exports
+
+def open_exports(config_yaml, admin_user=None, admin_password=None):
+    '''Migrators of the exports listed in 'exports', e.g. the workspaces of an
+    Enterprise Grid. They share the session, the download cache, the memory
+    budget, the uploaded files and the Matrix users.'''
+    exports = export_configs(config_yaml)
+    states = [open_state(stateFile) for config, stateFile in exports]
+
+    # users registered by earlier runs of any of the exports
+    users = UserDirectory()
+    for state in states:
+        for details in state.users():
+            users.add(details)
+
+    first = Migrator(exports[0][0], states[0], users=users, admin_user=admin_user, admin_password=admin_password)
+    # asked for once for all exports
+    first.admin_user, first.admin_password = first.ask_admin()
+    # one connection pool for the room workers of all exports
+    workers = min(len(exports), config_yaml.get("export-workers", 4))
+    first.use_session(first.new_session(first.config["room-workers"] * workers))
+
+    migrators = [first]
+    for (config, stateFile), state in zip(exports[1:], states[1:]):
+        migrators.append(Migrator(config, state, session=first.session, cache=first.config.get("cache"), memory=first.config["memory"], users=users, uploads=first.config["uploads"], admin_user=first.admin_user, admin_password=first.admin_password))
+    return migrators
+
+def run_exports(migrators, workers, command, *args):
+    '''runs a command of the Migrators, 'migrate' and 'provision' run for
+    workers exports at once'''
+    if command in ("migrate", "provision"):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for migrator in migrators:
+                futures[pool.submit(getattr(migrator, command), *args)] = migrator
+
+            for future in as_completed(futures):
+                if future.exception():
+                    print("ERROR while migrating export '" + futures[future].config["zipfile"] + "': " + str(future.exception()))
+    else:
+        for migrator in migrators:
+            print("Export " + migrator.config["zipfile"])
+            getattr(migrator, command)(*args)
 
-    # clean up postponed messages
-    later = []
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a Slack export to Matrix")
+    parser.add_argument("-c", "--config", default="config.yaml", help="config file (default: config.yaml)")
+    parser.add_argument("--state", default="luts.db", help="state file of the migration (default: luts.db)")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    # selection of the export, overrides the config
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument("--channel", action="append", metavar="GLOB", help="only migrate channels matching GLOB, can be repeated")
+    selection.add_argument("--exclude-channel", action="append", metavar="GLOB", help="don't migrate channels matching GLOB, can be repeated")
+    selection.add_argument("--no-dms", action="store_true", help="don't migrate direct messages")
+    selection.add_argument("--since", metavar="YYYY-MM-DD", help="only migrate days from this date on")
+    selection.add_argument("--until", metavar="YYYY-MM-DD", help="only migrate days up to this date")
+    selection.add_argument("--day-files", metavar="FILE", help="only migrate the day files (and messages) listed in FILE, e.g. written by 'verify'")
+
+    commands.add_parser("plan", parents=[selection], help="show the rooms of the export in the order they will be migrated")
+    commands.add_parser("provision", parents=[selection], help="only create users and rooms, e.g. before migrating shards")
+    migrateParser = commands.add_parser("migrate", parents=[selection], help="migrate users, rooms and messages (default)")
+    migrateParser.add_argument("--shard", type=parse_shard, metavar="i/N", help="only migrate the messages of shard i of N, users and rooms must be provisioned")
+    mergeParser = commands.add_parser("merge", help="merge the state files of shards into the state file")
+    mergeParser.add_argument("shards", nargs="+", help="state files of the shards")
+    commands.add_parser("kick", help="kick the imported users from the migrated rooms")
+    redriveParser = commands.add_parser("redrive", help="replay the users, rooms, files and events that failed (dry-run lists them)")
+    redriveParser.add_argument("--workers", type=int, default=8, help="concurrent replays (default: 8)")
+    verifyParser = commands.add_parser("verify", parents=[selection], help="compare the migrated rooms with the export and list the day files with missing messages")
+    verifyParser.add_argument("--workers", type=int, default=8, help="rooms read concurrently (default: 8)")
+    verifyParser.add_argument("--output", default="gaps.txt", help="file the missing messages are written to, by day file, see --day-files (default: gaps.txt)")
+    canaryParser = commands.add_parser("canary", parents=[selection], help="migrate sampled rooms into throwaway rooms to measure the homeserver and recommend room-workers")
+    canaryParser.add_argument("--rooms", type=int, default=1, help="rooms sampled from the small, medium and large rooms each (default: 1)")
+    canaryParser.add_argument("--concurrency", type=parse_levels, default=[1, 2, 4, 8], metavar="N,N,...", help="numbers of room workers to measure (default: 1,2,4,8)")
+    canaryParser.add_argument("--keep", action="store_true", help="don't delete the canary rooms")
+    parser.set_defaults(shard=None)
+    args = parser.parse_args()
 
-    # send events to dms
-    print("Migrating messages to DMs. This may take a while...")
-    for slack_room, matrix_room in dmLUT.items():
-        fileList = sorted(loadZipFolder(config, slack_room))
-        if fileList:
-            tick = 1/len(fileList)
-            migrate_messages(fileList, matrix_room, config, tick)
+    logging.captureWarnings(True)
+    log_to("migration.log")
 
-    # clean up postponed messages
-    later = []
+    try:
+        run_command(args)
+    except MigrationError as e:
+        print(str(e))
+        sys.exit(1)
 
-    # kick imported users from non-dm rooms
-    if config_yaml["kick-imported-users"]:
-        print("Kicking imported users from rooms. This may take a while...")
-        tick = 1/len(roomLUT)
-        kick_imported_users(config["homeserver"], admin_user, access_token, tick)
+def run_command(args):
+    config_yaml = load_config(args.config)
+    if getattr(args, "channel", None):
+        config_yaml["channels"] = args.channel
+    if getattr(args, "exclude_channel", None):
+        config_yaml["exclude-channels"] = args.exclude_channel
+    if getattr(args, "no_dms", False):
+        config_yaml["dms"] = False
+    if getattr(args, "since", None):
+        config_yaml["since"] = args.since
+    if getattr(args, "until", None):
+        config_yaml["until"] = args.until
+    if getattr(args, "day_files", None):
+        config_yaml["day-files"] = args.day_files
+
+    # several exports, each with its own state file
+    if config_yaml.get("exports"):
+        if args.command in ("merge", "verify", "canary") or args.shard:
+            raise MigrationError("'%s' works on a single export, run it with a config of one of the exports" % (args.command if not args.shard else "migrate --shard",))
+        migrators = open_exports(config_yaml)
+        workers = min(len(migrators), config_yaml.get("export-workers", 4))
+        if args.command == "redrive":
+            run_exports(migrators, workers, "redrive", args.workers)
+        else:
+            run_exports(migrators, workers, args.command or "migrate")
+        return
 
+    # load luts from previous run, an existing luts.yaml is converted once
+    if args.shard:
+        state = open_state(shard_state(args.state, args.shard))
+    else:
+        state = open_state(args.state)
+
+    migrator = Migrator(config_yaml, state)
+    if args.command == "plan":
+        migrator.plan()
+    elif args.command == "provision":
+        migrator.provision()
+    elif args.command == "merge":
+        migrator.merge(args.shards)
+    elif args.command == "kick":
+        migrator.kick()
+    elif args.command == "redrive":
+        migrator.redrive(args.workers)
+    elif args.command == "canary":
+        migrator.canary(args.rooms, args.concurrency, args.keep)
+    elif args.command == "verify":
+        migrator.verify(args.workers, args.output)
+    else:
+        migrator.migrate(args.shard)
 
 if __name__ == "__main__":
     main()
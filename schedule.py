@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Orders rooms for the message migration, longest first.
+ *
+ * The duration of a room is predicted from the number of its messages, known
+ * once the room has been migrated, or else from the uncompressed size of its
+ * day files. The rates start with a rough default and are refined with the
+ * actual duration of every migrated room, the totals and the message counts
+ * of the rooms are kept in luts.db (scheduleStats) so the next run starts
+ * with calibrated rates.
+'''
+
+import threading
+from filters import day_selected
+
+# rough starting point: about 100 messages of 200 bytes in 20 seconds
+defaultSecondsPerByte = 1 / 1000.0
+
+statsLock = threading.Lock()
+
+def room_job(config, slack_room, matrix_room, folder, is_dm):
+    source = config["source"]
+    fileList = sorted(file for file in source.list_folder(folder) if day_selected(config, file))
+    return {
+        "slack_room": slack_room,
+        "matrix_room": matrix_room,
+        "folder": folder,
+        "is_dm": is_dm,
+        "files": fileList,
+        "bytes": sum(source.size(file) for file in fileList),
+    }
+
+def seconds_per_byte(stats):
+    if stats.get("bytes"):
+        return stats["seconds"] / stats["bytes"]
+    return defaultSecondsPerByte
+
+def seconds_per_message(stats):
+    if stats.get("messages"):
+        return stats["message_seconds"] / stats["messages"]
+    return None
+
+def estimate(job, stats):
+    # counting the messages up front would mean parsing the whole export,
+    # the count of the last migration of the room is used instead
+    messages = stats.get("rooms", {}).get(job["slack_room"])
+    perMessage = seconds_per_message(stats)
+    if messages is not None and perMessage is not None:
+        return messages * perMessage
+    return job["bytes"] * seconds_per_byte(stats)
+
+def order_rooms(jobs, stats):
+    # longest processing time first: the big rooms start right away and the
+    # many small DMs fill up the workers towards the end of the run
+    for job in jobs:
+        job["predicted"] = estimate(job, stats)
+    return sorted(jobs, key=lambda job: job["predicted"], reverse=True)
+
+def shard_jobs(jobs, index, count):
+    '''the rooms of shard index (1 based) out of count shards
+
+    The rooms are distributed by size, the biggest room to the shard with
+    the least bytes so far. Only the export is used, so every shard computes
+    the same partition on its own.
+    '''
+    shards = [0] * count
+    selected = set()
+    for job in sorted(jobs, key=lambda job: (-job["bytes"], job["slack_room"])):
+        shard = shards.index(min(shards))
+        shards[shard] += job["bytes"]
+        if shard == index - 1:
+            selected.add(job["slack_room"])
+    # keep the order the rooms were scheduled in
+    return [job for job in jobs if job["slack_room"] in selected]
+
+def record(stats, job, seconds, messages):
+    with statsLock:
+        stats["bytes"] = stats.get("bytes", 0) + job["bytes"]
+        stats["seconds"] = stats.get("seconds", 0.0) + seconds
+        # kept apart from seconds, older state files only counted bytes
+        stats["messages"] = stats.get("messages", 0) + messages
+        stats["message_seconds"] = stats.get("message_seconds", 0.0) + seconds
+        stats.setdefault("rooms", {})[job["slack_room"]] = messages
+
+def snapshot(stats):
+    # other workers keep recording while the stats are saved
+    with statsLock:
+        return dict(stats, rooms=dict(stats.get("rooms", {})))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Readers for the different layouts of a Slack export.
+ *
+ * All sources offer the same interface:
+ *   open_metadata(name)      file object of a top-level file like "users.json", None if missing
+ *   list_folder(folder)      day files ("folder/YYYY-MM-DD.json") of a channel folder
+ *   size(file)               uncompressed size of a day file in bytes
+ *   sequential               True if files can only be read in archive order
+ *   iter_messages(fileList)  yields (file, messages) for the given day files in order
+'''
+
+import io
+import mmap
+import os
+import tarfile
+import threading
+import zipfile
+from contextlib import contextmanager
+from utils import print, json_loads
+
+tarSuffixes = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst", ".tzst")
+zstdSuffixes = (".tar.zst", ".tzst")
+
+def open_source(path):
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if path.endswith(tarSuffixes):
+        return TarSource(path)
+    return ZipSource(path)
+
+def load_messages(file, data):
+    try:
+        return json_loads(data)
+    except ValueError:
+        print("Warning: Couldn't load data from file " + file + " in archive. Skipping this file.")
+        return None
+
+class ZipSource(object):
+    '''the zip file as downloaded from Slack'''
+
+    sequential = False
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = zipfile.ZipFile(path, 'r')
+        self.folders = {}
+        self.sizes = {}
+        for entry in self.archive.infolist():
+            if entry.is_dir():
+                continue
+            folder = entry.filename.split("/", maxsplit=1)[0]
+            if folder != entry.filename:
+                self.folders.setdefault(folder, []).append(entry.filename)
+                self.sizes[entry.filename] = entry.file_size
+
+    def open_metadata(self, name):
+        try:
+            return self.archive.open(name)
+        except KeyError:
+            return None
+
+    def list_folder(self, folder):
+        return list(self.folders.get(folder, []))
+
+    def size(self, file):
+        return self.sizes.get(file, 0)
+
+    def iter_messages(self, fileList):
+        for file in fileList:
+            try:
+                data = self.archive.read(file)
+            except KeyError:
+                print("Warning: Couldn't find file " + file + " in archive. Skipping this file.")
+                continue
+            messageData = load_messages(file, data)
+            if messageData is not None:
+                yield file, messageData
+
+@contextmanager
+def mapped_file(filename):
+    # map the file instead of reading it, the pages are shared with every
+    # other process reading the same export and parsed without a copy; the
+    # view is only valid inside the with block
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+class DirectorySource(object):
+    '''an already extracted export, files are read through mmap'''
+
+    sequential = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def open_metadata(self, name):
+        filename = os.path.join(self.path, name)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return io.BytesIO(f.read())
+
+    def list_folder(self, folder):
+        directory = os.path.join(self.path, folder)
+        if not os.path.isdir(directory):
+            return []
+        return [folder + "/" + name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name))]
+
+    def size(self, file):
+        try:
+            return os.path.getsize(os.path.join(self.path, file))
+        except OSError:
+            return 0
+
+    def iter_messages(self, fileList):
+        for file in fileList:
+            try:
+                with mapped_file(os.path.join(self.path, file)) as data:
+                    messageData = load_messages(file, data)
+            except OSError:
+                print("Warning: Couldn't find file " + file + " in export. Skipping this file.")
+                continue
+            if messageData is not None:
+                yield file, messageData
+
+def open_tar_stream(path):
+    if path.endswith(zstdSuffixes):
+        # optional dependency, only needed for zstd compressed exports
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return tarfile.open(fileobj=stream, mode='r|')
+    return tarfile.open(path, mode='r|*')
+
+class TarSource(object):
+    '''a tar (optionally gz/bz2/xz/zstd compressed) export
+
+    Uncompressed tars are memory-mapped and read at the member offsets.
+    Compressed tars can only be read as a stream: the stream is kept open
+    and day files are collected while walking forward, so folders requested
+    in archive order are read in a single pass over the archive.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.metadata = {}
+        self.folders = {}
+        self.sizes = {}
+        self.offsets = {}
+        self.order = {}
+        self.mapped = None
+        self.stream = None
+        self.position = 0
+
+        seekable = path.endswith(".tar")
+        self.sequential = not seekable
+        tar = tarfile.open(path, mode='r:') if seekable else open_tar_stream(path)
+        with tar:
+            for index, member in enumerate(tar):
+                if not member.isfile():
+                    continue
+                name = member.name[2:] if member.name.startswith("./") else member.name
+                self.order[name] = index
+                folder = name.split("/", maxsplit=1)[0]
+                if folder == name:
+                    # top-level files are small, keep them
+                    self.metadata[name] = tar.extractfile(member).read()
+                else:
+                    self.folders.setdefault(folder, []).append(name)
+                    self.sizes[name] = member.size
+                    if seekable:
+                        self.offsets[name] = (member.offset_data, member.size)
+
+        if seekable:
+            f = open(path, 'rb')
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+
+    def open_metadata(self, name):
+        if not name in self.metadata:
+            return None
+        return io.BytesIO(self.metadata[name])
+
+    def list_folder(self, folder):
+        return list(self.folders.get(folder, []))
+
+    def size(self, file):
+        return self.sizes.get(file, 0)
+
+    def read_stream(self, fileList):
+        wanted = set(fileList)
+        found = {}
+        with self.lock:
+            # restart the stream if a file lies behind the current position
+            if self.stream is None or min(self.order.get(file, 0) for file in fileList) < self.position:
+                if self.stream is not None:
+                    self.stream.close()
+                self.stream = open_tar_stream(self.path)
+                self.members = iter(self.stream)
+                self.position = 0
+
+            last = max(self.order.get(file, 0) for file in fileList)
+            while self.position <= last:
+                member = next(self.members, None)
+                if member is None:
+                    break
+                if member.isfile():
+                    name = member.name[2:] if member.name.startswith("./") else member.name
+                    self.position = self.order[name] + 1
+                    if name in wanted:
+                        found[name] = self.stream.extractfile(member).read()
+        return found
+
+    def iter_messages(self, fileList):
+        if not fileList:
+            return
+
+        if self.mapped is None:
+            found = self.read_stream(fileList)
+
+        for file in fileList:
+            if self.mapped is not None:
+                if not file in self.offsets:
+                    data = None
+                else:
+                    offset, size = self.offsets[file]
+                    # parsed straight from the mapping, without a copy
+                    data = memoryview(self.mapped)[offset:offset + size]
+            else:
+                data = found.pop(file, None)
+
+            if data is None:
+                print("Warning: Couldn't find file " + file + " in archive. Skipping this file.")
+                continue
+            messageData = load_messages(file, data)
+            if messageData is not None:
+                yield file, messageData
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * State of a migration (the LUTs) in a SQLite file.
+ *
+ * Every LUT is a set of rows in the "luts" table and only loaded when it is
+ * asked for. Values are stored as JSON. The registered users (including
+ * their generated passwords) are kept in their own table and never loaded
+ * unless needed.
+ *
+ * Operations that failed are kept in the "deadletters" table, the "events"
+ * table maps Slack messages to the events sent when they are replayed.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+from utils import print, lazy_import
+
+yaml = lazy_import("yaml")
+
+lutNames = ["userLUT", "nameLUT", "roomLUT", "roomLUT2", "dmLUT", "watermarkLUT", "scheduleStats"]
+
+def open_state(path, yamlPath="luts.yaml"):
+    # convert the state of runs before the state file existed, once
+    if not os.path.isfile(path) and os.path.isfile(yamlPath):
+        print("Converting " + yamlPath + " to " + path)
+        with open(yamlPath, "r") as f:
+            luts = yaml.load(f.read(), Loader=yaml.FullLoader)
+        state = State(path)
+        for name in lutNames:
+            if name in luts:
+                state.save(name, luts[name])
+        state.add_users(luts.get("users", []))
+        os.rename(yamlPath, yamlPath + ".converted")
+        return state
+
+    return State(path)
+
+class State(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.luts = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS luts (lut TEXT, key TEXT, value TEXT, PRIMARY KEY (lut, key))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS users (slack_id TEXT PRIMARY KEY, details TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS deadletters (id INTEGER PRIMARY KEY, kind TEXT, room TEXT, ref TEXT, content TEXT, error TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS events (room TEXT, user TEXT, ts TEXT, event_id TEXT, PRIMARY KEY (room, user, ts))")
+
+    def is_empty(self):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM luts LIMIT 1").fetchone() is None
+
+    def load(self, name):
+        '''the LUT as dict, read from the file on first use'''
+        with self.lock:
+            if not name in self.luts:
+                rows = self.db.execute("SELECT key, value FROM luts WHERE lut = ?", (name,))
+                self.luts[name] = {key: json.loads(value) for key, value in rows}
+            return self.luts[name]
+
+    def save(self, name, lut):
+        '''replace the stored LUT'''
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM luts WHERE lut = ?", (name,))
+            self.db.executemany("INSERT INTO luts VALUES (?, ?, ?)", [(name, key, json.dumps(value)) for key, value in lut.items()])
+            self.luts[name] = lut
+
+    def put(self, name, key, value):
+        '''store a single entry of a LUT'''
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO luts VALUES (?, ?, ?)", (name, key, json.dumps(value)))
+
+    def copy_to(self, path):
+        '''write a copy of the state to path'''
+        target = sqlite3.connect(path)
+        with self.lock:
+            self.db.backup(target)
+        target.close()
+
+    def add_users(self, users):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)", [(user["slack_id"], json.dumps(user)) for user in users])
+
+    def add_dead_letter(self, kind, room, ref, content, error):
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO deadletters (kind, room, ref, content, error) VALUES (?, ?, ?, ?, ?)", (kind, room, json.dumps(ref), json.dumps(content), error))
+
+    def dead_letters(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, kind, room, ref, content, error FROM deadletters ORDER BY id").fetchall()
+        return [{"id": id, "kind": kind, "room": room, "ref": json.loads(ref), "content": json.loads(content), "error": error} for id, kind, room, ref, content, error in rows]
+
+    def set_dead_letter_error(self, id, error):
+        with self.lock, self.db:
+            self.db.execute("UPDATE deadletters SET error = ? WHERE id = ?", (error, id))
+
+    def remove_dead_letter(self, id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM deadletters WHERE id = ?", (id,))
+
+    def put_event(self, room, user, ts, eventId):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)", (room, user, ts, eventId))
+
+    def event_id(self, room, user, ts):
+        with self.lock:
+            row = self.db.execute("SELECT event_id FROM events WHERE room = ? AND user = ? AND ts = ?", (room, user, ts)).fetchone()
+        return row[0] if row else None
+
+    def users(self):
+        with self.lock:
+            rows = self.db.execute("SELECT details FROM users").fetchall()
+        return [json.loads(details) for (details,) in rows]
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Thumbnails made from the downloaded original instead of a second download
+ * from Slack (config["local-thumbnails"]).
+ *
+ * Images need Pillow (`pip3 install Pillow`), videos the ffmpeg executable.
+ * Without them the thumbnails are downloaded from Slack as before.
+'''
+
+import importlib.util
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+from utils import print, lazy_import
+
+Image = lazy_import("PIL.Image")
+
+# the size of Slack's thumb_360
+thumbnailSize = 360
+
+def have_pillow():
+    return importlib.util.find_spec("PIL") is not None
+
+def have_ffmpeg():
+    return shutil.which("ffmpeg") is not None
+
+def jpeg_size(data):
+    '''(width, height) from the start of frame segment of a JPEG'''
+    offset = 2
+    while offset + 9 < len(data):
+        marker, length = data[offset + 1], int.from_bytes(data[offset + 2:offset + 4], "big")
+        # SOF0 .. SOF15 without DHT, JPG and DAC
+        if 0xC0 <= marker <= 0xCF and not marker in (0xC4, 0xC8, 0xCC):
+            return int.from_bytes(data[offset + 7:offset + 9], "big"), int.from_bytes(data[offset + 5:offset + 7], "big")
+        offset += 2 + length
+    return None
+
+def image_thumbnail(data):
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((thumbnailSize, thumbnailSize))
+    out = io.BytesIO()
+    # keep transparency, everything else is a JPEG like Slack's thumbnails
+    if image.mode in ("RGBA", "LA", "P"):
+        image.save(out, "PNG")
+        mimetype = "image/png"
+    else:
+        image.convert("RGB").save(out, "JPEG", quality=80)
+        mimetype = "image/jpeg"
+    return out.getvalue(), mimetype, image.width, image.height
+
+def video_thumbnail(data):
+    # the index of an mp4 may be at its end, ffmpeg needs a seekable file
+    fd, path = tempfile.mkstemp(prefix="slack-video-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        scale = "scale='min(%d,iw)':'min(%d,ih)':force_original_aspect_ratio=decrease" % (thumbnailSize, thumbnailSize)
+        res = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-frames:v", "1", "-vf", scale, "-f", "image2", "-c:v", "mjpeg", "pipe:1"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    finally:
+        os.remove(path)
+    if res.returncode != 0 or not res.stdout:
+        print("Warning: ffmpeg could not extract a frame: " + res.stderr.decode("utf-8", "replace").strip())
+        return None
+    size = jpeg_size(res.stdout)
+    if size is None:
+        return None
+    return res.stdout, "image/jpeg", size[0], size[1]
+
+def make_thumbnail(data, mimetype):
+    '''(thumbnail, mimetype, width, height) of an image or video, None if it
+    can't be made here'''
+    try:
+        if mimetype.startswith("image/") and have_pillow():
+            return image_thumbnail(data)
+        if mimetype.startswith("video/") and have_ffmpeg():
+            return video_thumbnail(data)
+    except Exception as e:
+        print("Warning: could not make a thumbnail: " + str(e))
+    return None
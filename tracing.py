@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Spans of the migration in the Chrome trace format (config["trace-file"]),
+ * open the file in https://ui.perfetto.dev or chrome://tracing.
+ *
+ * Every room and the reading of its day files are traced. Of the messages
+ * only a sample (config["trace-sample-rate"]) is traced with everything
+ * they do: transforming the text, files, HTTP requests with their status
+ * and retries and the reactions sent by the reaction workers.
+'''
+
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from utils import print
+
+# kind of an HTTP request by its URL, everything else is a download from Slack
+requestKinds = [("send", "/send/"), ("upload", "/upload"), ("join", "/join"), ("create", "/createRoom"), ("register", "/register")]
+
+def now():
+    # the trace format counts microseconds
+    return time.time() * 1000000
+
+class Tracer(object):
+    '''collects the spans, does nothing if path is empty'''
+
+    def __init__(self, path, sampleRate=0.01):
+        self.path = path
+        self.sampleRate = sampleRate
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def sampled(self):
+        return getattr(self.local, "sampled", False)
+
+    def add(self, name, cat, start, args):
+        thread = threading.current_thread()
+        with self.lock:
+            if not thread.ident in self.threads:
+                self.threads[thread.ident] = thread.name
+            self.events.append({"name": name, "cat": cat, "ph": "X", "ts": start, "dur": now() - start, "pid": os.getpid(), "tid": thread.ident, "args": args})
+
+    @contextmanager
+    def span(self, name, cat, always=False, **args):
+        '''traces the block if the current message is sampled or always, the
+        yielded args can be filled in by the block'''
+        if not self.enabled or not (always or self.sampled()):
+            yield args
+            return
+        start = now()
+        try:
+            yield args
+        finally:
+            self.add(name, cat, start, args)
+
+    @contextmanager
+    def message(self, message):
+        '''samples the message by its ts, so every run traces the same ones'''
+        sampled = self.enabled and zlib.crc32(message.get("ts", "").encode()) < self.sampleRate * 0x100000000
+        self.local.sampled = sampled
+        try:
+            with self.span("message", "message", subtype=message.get("subtype", ""), user=message.get("user", ""), ts=message.get("ts", "")):
+                yield
+        finally:
+            self.local.sampled = False
+
+    def reads(self, dayFiles):
+        '''traces reading and parsing each (file, messages) of dayFiles'''
+        iterator = iter(dayFiles)
+        while True:
+            start = now()
+            item = next(iterator, None)
+            if item is None:
+                return
+            if self.enabled:
+                self.add("read", "room", start, {"file": item[0], "messages": len(item[1])})
+            yield item
+
+    def carry(self, func):
+        '''func for another thread, traced if the current message is sampled'''
+        sampled = self.sampled()
+        def traced(*args):
+            self.local.sampled = sampled
+            try:
+                return func(*args)
+            finally:
+                self.local.sampled = False
+        return traced
+
+    def response(self, r, *args, **kwargs):
+        # response hook of requests, runs in the thread that sent the request
+        if not self.enabled or not self.sampled():
+            return
+        kind = next((kind for kind, path in requestKinds if path in r.url), "download")
+        retries = getattr(getattr(r.raw, "retries", None), "history", ())
+        self.add(kind, "http", now() - r.elapsed.total_seconds() * 1000000, {"method": r.request.method, "status": r.status_code, "retries": len(retries)})
+
+    def save(self, suffix=""):
+        if not self.enabled:
+            return
+        path = self.path + suffix
+        with self.lock:
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}} for ident, name in self.threads.items()]
+            events = metadata + self.events
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print("Wrote %d spans to %s" % (len(events) - len(metadata), path))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, 2020 Awesome Technologies Innovationslabor GmbH
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+ * Matrix users of one or several exports ('exports' in the config).
+ *
+ * The workspaces of an Enterprise Grid share their users: a Slack user that
+ * is in several exports (same Slack id or email) gets a single Matrix user.
+ * Different people with the same name in different workspaces get the
+ * team id appended to their localpart.
+'''
+
+import threading
+
+class UserDirectory(object):
+
+    def __init__(self):
+        # exports register their users one after the other
+        self.lock = threading.RLock()
+        self.byId = {}
+        self.byEmail = {}
+        self.localparts = set()
+        # Matrix ids reserved by an export that is still registering them
+        self.pending = {}
+
+    def add(self, details):
+        '''a registered user, details as kept in the state file'''
+        with self.lock:
+            self.byId[details["slack_id"]] = details["matrix_id"]
+            if details.get("slack_email"):
+                self.byEmail[details["slack_email"].lower()] = details["matrix_id"]
+            self.localparts.add(details["matrix_user"])
+
+    def reserve(self, details):
+        '''a user that is about to be registered, call registered() after'''
+        with self.lock:
+            self.add(details)
+            self.pending[details["matrix_id"]] = threading.Event()
+
+    def registered(self, matrixId):
+        '''the registration of a reserved user is done, whether it worked or not'''
+        with self.lock:
+            self.pending.pop(matrixId).set()
+
+    def wait(self, matrixId):
+        '''waits until another export is done registering matrixId'''
+        with self.lock:
+            event = self.pending.get(matrixId)
+        if event:
+            event.wait()
+
+    def find(self, user):
+        '''Matrix id of a Slack user (from users.json) that is already registered'''
+        with self.lock:
+            if user["id"] in self.byId:
+                return self.byId[user["id"]]
+            email = user["profile"].get("email")
+            if email:
+                return self.byEmail.get(email.lower())
+            return None
+
+    def localpart(self, user):
+        with self.lock:
+            if not user["name"] in self.localparts:
+                return user["name"]
+            return user["name"] + "-" + user["team_id"].lower()
@@ -13,26 +13,130 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import requests
-import functools
-
-def super_print(filename):
-    '''filename is the file where output will be written'''
-    def wrap(func):
-        '''func is the function you are "overriding", i.e. wrapping'''
-        def wrapped_func(*args,**kwargs):
-            '''*args and **kwargs are the arguments supplied
-            to the overridden function'''
-            #use with statement to open, write to, and close the file safely
-            with open(filename,'a') as outputfile:
-                outputfile.write(*args,**kwargs)
-                outputfile.write("\n")
-            #now original function executed with its arguments as normal
-            return func(*args,**kwargs)
-        return wrapped_func
-    return wrap
-
-print = super_print('migration.log')(print)
+import builtins
+import hashlib
+import importlib
+import json
+import threading
+from contextlib import contextmanager
+
+# orjson parses and serializes several times faster, the stdlib is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class LazyModule(object):
+    '''a module imported on first attribute access, keeps the startup of
+    commands that don't need it fast'''
+
+    lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        # the workers of a migration may touch a module for the first time concurrently
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+def lazy_import(name):
+    return LazyModule(name)
+
+requests = lazy_import("requests")
+
+def json_loads(data):
+    '''parse JSON from bytes, a memoryview or str'''
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+def json_dumps(obj):
+    '''serialize to UTF-8 encoded JSON bytes, ready to be sent'''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+jsonHeaders = {"Content-Type": "application/json"}
+
+logfile = None
+logLock = threading.Lock()
+
+def log_to(filename):
+    '''also write everything printed through print() to filename'''
+    global logfile
+    logfile = open(filename, 'a')
+
+def print(*args, **kwargs):
+    if logfile:
+        with logLock:
+            logfile.write(" ".join([str(arg) for arg in args]))
+            logfile.write("\n")
+            logfile.flush()
+    return builtins.print(*args, **kwargs)
+
+errors = threading.local()
+
+def record_error(r):
+    '''remember the error of a failed request of this thread'''
+    error = "%d %s" % (r.status_code, r.reason)
+    try:
+        error = error + ": " + r.json()["error"]
+    except Exception:
+        pass
+    errors.last = error
+
+def last_error():
+    return getattr(errors, "last", "")
+
+def dead_letter(config, kind, room, ref, content, error=None):
+    '''keep a failed operation in the state for a later 'redrive'
+
+    ref identifies the Slack origin (e.g. user and ts of a message), content
+    is everything needed to replay it.
+    '''
+    captured = getattr(errors, "captured", None)
+    if captured is not None:
+        captured.append(error or last_error())
+    elif config.get("state"):
+        config["state"].add_dead_letter(kind, room, ref, content, error or last_error())
+
+@contextmanager
+def capture_dead_letters():
+    '''the errors of the operations failing in this thread instead of new dead
+    letters, for replaying a dead letter that is kept until it succeeds'''
+    errors.captured = []
+    try:
+        yield errors.captured
+    finally:
+        errors.captured = None
+
+def dead_letter_event(config, ref, matrix_message, matrix_room, matrix_user_id, event_type, txnId, ts=0, parent=None):
+    '''a send_event that failed, parent is the Slack ref of the message the
+    event relates to if its event id is not known yet'''
+    content = {
+        "type": event_type,
+        "content": matrix_message,
+        "user": matrix_user_id,
+        "txnId": txnId,
+        "ts": ts,
+        "parent": parent,
+    }
+    dead_letter(config, "event", matrix_room, ref, content)
+
+def make_txn_id(*parts):
+    '''derive a transaction id from the identity of the Slack content, e.g.
+    (room, Slack user, ts) for a message or (message txnId, "file", index)
+    for its files, so resending the same content reuses the same txnId and
+    the homeserver deduplicates it'''
+    key = "|".join([str(part) for part in parts])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
 
 def send_event(
     config,
@@ -50,13 +154,14 @@ def send_event(
         url = "%s/_matrix/client/r0/rooms/%s/send/%s/%s?user_id=%s" % (config["homeserver"],matrix_room,event_type,txnId,matrix_user_id,)
 
     #_print("Sending registration request...")
-    r = requests.put(url, headers={'Authorization': 'Bearer ' + config["as_token"]}, json=matrix_message, verify=False)
+    r = config["session"].put(url, headers=dict(jsonHeaders, Authorization='Bearer ' + config["as_token"]), data=json_dumps(matrix_message), verify=False)
 
     if r.status_code != 200:
         print("ERROR! Received %d %s" % (r.status_code, r.reason))
+        record_error(r)
         if 400 <= r.status_code < 500:
             try:
-                print(' '.join([r.status_code, r.json()["error"]]))
+                print(r.json()["error"])
                 #print(matrix_message)
             except Exception:
                 pass